@@ -0,0 +1,149 @@
+import os
+import time
+import threading
+import logging
+from functools import wraps
+from typing import Dict, Any, Optional
+
+from flask import jsonify
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Admission control for slow (LLM-bound) endpoints
+# ----------------------------
+class AdmissionLimiter:
+    """Caps in-flight requests for one endpoint class and sheds load once the wait queue is full.
+
+    If ``target_latency`` is set the limit adapts (AIMD): it shrinks when requests
+    run slower than the target and grows back one slot at a time when they are fast.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        max_queue: int,
+        queue_timeout: float,
+        retry_after: int,
+        target_latency: Optional[float] = None,
+        min_concurrency: int = 1,
+    ):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.target_latency = target_latency
+
+        self.limit = self.max_concurrency
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.latency_ewma = 0.0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> bool:
+        """Take a slot, waiting in the bounded queue if needed. Returns False when shed."""
+        with self._cond:
+            if self.active < self.limit and self.waiting == 0:
+                self.active += 1
+                return True
+
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+
+            self.waiting += 1
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+            self.active += 1
+            return True
+
+    def release(self, latency: float) -> None:
+        with self._cond:
+            self.active -= 1
+            self.latency_ewma = latency if not self.latency_ewma else 0.8 * self.latency_ewma + 0.2 * latency
+
+            if self.target_latency:
+                self._adapt(latency)
+
+            self._cond.notify_all()
+
+    def _adapt(self, latency: float) -> None:
+        if latency > self.target_latency:
+            new_limit = max(self.min_concurrency, int(self.limit * 0.75))
+            if new_limit != self.limit:
+                logger.warning(
+                    f"Admission limit for '{self.name}' lowered {self.limit} -> {new_limit} "
+                    f"(latency {latency:.2f}s > target {self.target_latency:.2f}s)"
+                )
+            self.limit = new_limit
+            self._successes = 0
+        else:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "max_concurrency": self.max_concurrency,
+                "active": self.active,
+                "waiting": self.waiting,
+                "max_queue": self.max_queue,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "latency_ewma": round(self.latency_ewma, 3),
+            }
+
+
+def limiter_from_env(name: str, default_concurrency: int, default_queue: int) -> AdmissionLimiter:
+    """Build a limiter from ``<NAME>_MAX_CONCURRENCY``, ``<NAME>_MAX_QUEUE``, ``<NAME>_QUEUE_TIMEOUT``,
+    ``<NAME>_RETRY_AFTER`` and ``<NAME>_TARGET_LATENCY`` (seconds, enables adaptive limits)."""
+    prefix = name.upper()
+    target_latency = os.getenv(f"{prefix}_TARGET_LATENCY")
+    return AdmissionLimiter(
+        name=name,
+        max_concurrency=int(os.getenv(f"{prefix}_MAX_CONCURRENCY", default_concurrency)),
+        max_queue=int(os.getenv(f"{prefix}_MAX_QUEUE", default_queue)),
+        queue_timeout=float(os.getenv(f"{prefix}_QUEUE_TIMEOUT", 10)),
+        retry_after=int(os.getenv(f"{prefix}_RETRY_AFTER", 5)),
+        target_latency=float(target_latency) if target_latency else None,
+        min_concurrency=int(os.getenv(f"{prefix}_MIN_CONCURRENCY", 1)),
+    )
+
+
+def admission_controlled(limiter: AdmissionLimiter):
+    """Route decorator: run the view inside a limiter slot, or answer 503 + Retry-After."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not limiter.acquire():
+                logger.warning(f"Shedding request for '{limiter.name}': {limiter.snapshot()}")
+                response = jsonify({"error": "Server is busy, please retry later"})
+                response.status_code = 503
+                response.headers["Retry-After"] = str(limiter.retry_after)
+                return response
+
+            started = time.monotonic()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                limiter.release(time.monotonic() - started)
+        return wrapper
+    return decorator
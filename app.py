@@ -1,14 +1,33 @@
 import os
 import sys
 import logging
-from datetime import datetime
-from typing import Dict, Any, Optional
+import threading
+import time
+import hmac
+import hashlib
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
 
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, send_file, g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
 from dotenv import load_dotenv
 import google.generativeai as genai
 
+from admission import admission_controlled, limiter_from_env
+from message_codec import (
+    encode_content, decode_content, backfill_compression, storage_report,
+)
+from usage_ledger import UsageLedger, usage_report
+from profiling import RequestProfiler, profile_phase, profiled_connection
+from repository import Repository, configure_connection, migrate as migrate_schema
+from contact_profile import refresh_contact_profile, compact_profile, PROFILE_MAX_CONVERSATIONS
+from ingest_queue import get_writer, writer_stats
+from sharding import ShardRouter, validate_tenant, DEFAULT_TENANT, SHARD_DIR, TENANT_HEADER
+
 # ----------------------------
 # Logging & config
 # ----------------------------
@@ -29,6 +48,11 @@ app.config.update(
     JSON_AS_ASCII=False,
 )
 
+# Request profiling (off unless PROFILE_TOKEN / PROFILE_SAMPLE_RATE is set)
+profiler = RequestProfiler()
+profiler.init_app(app)
+app.json.ensure_ascii = False
+
 # ----------------------------
 # Database config (SQLite)
 # ----------------------------
@@ -36,7 +60,80 @@ DEFAULT_SQLITE = "sqlite:///conversations.db"
 DATABASE_URL = os.getenv("DATABASE_URL", DEFAULT_SQLITE)
 app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
+if DATABASE_URL.startswith("sqlite") and ":memory:" not in DATABASE_URL:
+    # Under gevent hundreds of requests share one worker; they only hold a
+    # pooled connection for short queries (see release_db_connection)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 20)),
+        "pool_timeout": 30,
+        "connect_args": {"timeout": 30},
+    }
+class TenantSession(Session):
+    """Routes every query of a tenant-bound request to that tenant's shard engine"""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        engine = tenant_engine()
+        if engine is not None:
+            return engine
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+db = SQLAlchemy(app, session_options={"class_": TenantSession})
+
+def tenant_engine():
+    """Engine of the tenant shard bound to the current context, or None for the default database"""
+    return g.get("tenant_engine") if has_app_context() else None
+
+def current_engine():
+    return tenant_engine() or db.engine
+
+def current_tenant_id() -> str:
+    return g.get("tenant_id", DEFAULT_TENANT) if has_app_context() else DEFAULT_TENANT
+
+def running_under_gevent() -> bool:
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("socket")
+
+def release_db_connection() -> None:
+    """End the current transaction so its pooled connection is not pinned while we wait on Gemini.
+
+    Loaded objects stay readable afterwards (no expiry on this commit), so the
+    request does not check the connection out again just to reload them.
+    """
+    session = db.session()
+    session.expire_on_commit = False
+    try:
+        session.commit()
+    finally:
+        session.expire_on_commit = True
+
+@contextmanager
+def open_repository():
+    """Shared data-access layer (repository.py) on the request session's own connection.
+
+    ORM queries and repository statements of a request then run on one
+    connection and see each other's writes. Repository writes start their own
+    BEGIN IMMEDIATE, so a transaction the ORM left open is committed first.
+    """
+    conn = db.session.connection().connection.dbapi_connection
+    if conn.in_transaction:
+        release_db_connection()
+        conn = db.session.connection().connection.dbapi_connection
+    # Times and counts each statement, not the caller's whole block
+    yield Repository(profiled_connection(conn))
+
+def store_message(conversation_id: int, content: str, direction: str, normalize: bool = True) -> Dict[str, Any]:
+    """Insert one message through the group-commit writer of the current database file"""
+    engine = current_engine()
+    database = engine.url.database
+    if engine.dialect.name == "sqlite" and database and database != ":memory:":
+        with profile_phase("db"):
+            return get_writer(database).add_message(conversation_id, content, direction, normalize)
+    with open_repository() as repo:
+        return repo.add_message(conversation_id, content, direction, normalize)
 
 # ----------------------------
 # Models (Enhanced with Context Summary)
@@ -50,6 +147,11 @@ class Contact(db.Model):
     company = db.Column(db.String(255))
     notes = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Cross-thread relationship profile (see contact_profile.py)
+    profile_summary = db.Column(db.Text)
+    profile_source_hash = db.Column(db.String(64))
+    profile_source_digests = db.Column(db.Text)
+    profile_updated_at = db.Column(db.DateTime)
     
     # Relationships
     conversations = db.relationship("Conversation", backref="contact", lazy=True)
@@ -63,44 +165,198 @@ class Conversation(db.Model):
     context_summary = db.Column(db.Text)  # 🧠 NEW: Rolling context summary
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    archived_at = db.Column(db.DateTime)  # set while messages live in conversation_archives
     
     # Relationships
     messages = db.relationship("ConversationMessage", backref="conversation", lazy=True, order_by="ConversationMessage.sequence")
+    archive = db.relationship("ConversationArchive", uselist=False, lazy=True)
 
 class ConversationMessage(db.Model):
     __tablename__ = "conversation_messages"
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey("conversations.id"), nullable=False)
-    content = db.Column(db.Text, nullable=False)
+    _content = db.Column("content", db.Text, nullable=False)  # empty when stored compressed
+    content_z = db.Column(db.LargeBinary)  # compressed body (see message_codec)
+    content_size = db.Column(db.Integer)  # uncompressed size in bytes
+    clean_content = db.Column(db.Text)  # body minus quoted history/signature; NULL when nothing was stripped
+    quoted_message_id = db.Column(db.Integer)  # earlier message the stripped quote duplicates
     direction = db.Column(db.String(20), nullable=False)  # 'sent' or 'received'
     sequence = db.Column(db.Integer)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    message_id = db.Column(db.Text)  # Message-ID header of mail ingested by mail_ingest.py
+
+    @property
+    def content(self) -> str:
+        return decode_content(self._content, self.content_z)
+
+    @content.setter
+    def content(self, value: str) -> None:
+        self._content, self.content_z, self.content_size = encode_content(value)
+
+    @property
+    def prompt_content(self) -> str:
+        """Novel text only - what prompts should see"""
+        return self.clean_content or self.content
+
+class ConversationArchive(db.Model):
+    """Cold tier: one compressed JSON blob holding every message of an archived thread"""
+    __tablename__ = "conversation_archives"
+    conversation_id = db.Column(db.Integer, db.ForeignKey("conversations.id"), primary_key=True)
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+    last_message = db.Column(db.Text)  # preview for list views, avoids opening the blob
+    payload = db.Column(db.LargeBinary, nullable=False)
+    raw_size = db.Column(db.Integer)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class LlmUsage(db.Model):
+    """One row per Gemini call (or cache hit), written in batches by usage_ledger"""
+    __tablename__ = "llm_usage"
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    source = db.Column(db.String(32))
+    tenant_id = db.Column(db.String(64))  # ids below are only unique within a tenant's shard
+    call_type = db.Column(db.String(50), nullable=False)  # 'summary', 'reply', ...
+    model = db.Column(db.String(100))
+    conversation_id = db.Column(db.Integer)
+    contact_id = db.Column(db.Integer)
+    prompt_tokens = db.Column(db.Integer)
+    response_tokens = db.Column(db.Integer)
+    latency_ms = db.Column(db.Float)
+    cache_hit = db.Column(db.Boolean, default=False)
+    error = db.Column(db.Text)
+
+class SummaryChunk(db.Model):
+    """Cached summary of one window of conversation text, keyed by a hash of that text"""
+    __tablename__ = "summary_chunks"
+    content_hash = db.Column(db.String(64), primary_key=True)
+    summary = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# ----------------------------
+# LLM usage ledger (batched background writes)
+# ----------------------------
+def write_usage_batch(rows: list) -> None:
+    with app.app_context():
+        try:
+            db.session.execute(LlmUsage.__table__.insert(), rows)
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+usage_ledger = UsageLedger(
+    write_usage_batch,
+    source="api",
+    flush_interval=float(os.getenv("USAGE_LEDGER_FLUSH_INTERVAL", 2.0)),
+)
 
 # ----------------------------
 # Enhanced Gemini wrapper with Context Management
 # ----------------------------
+RECENT_CONTEXT_MESSAGES = 3
+
+# Long threads are summarized map-reduce style in windows of this many tokens
+SUMMARY_WINDOW_TOKENS = int(os.getenv("SUMMARY_WINDOW_TOKENS", 6000))
+SUMMARY_PARALLELISM = int(os.getenv("SUMMARY_PARALLELISM", 4))
+SUMMARY_MAX_REDUCE_ROUNDS = int(os.getenv("SUMMARY_MAX_REDUCE_ROUNDS", 3))
+CHARS_PER_TOKEN = 4  # rough estimate, good enough for sizing windows
+SUMMARY_PROMPT_VERSION = "v1"  # bump to invalidate cached chunk summaries
+
+# Shared by all requests so total in-flight chunk calls stay bounded
+summary_pool = ThreadPoolExecutor(max_workers=SUMMARY_PARALLELISM, thread_name_prefix="summary")
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN
+
+def split_into_windows(parts: List[str], max_tokens: int) -> List[List[str]]:
+    """Greedy windows on part boundaries, always starting from the first part.
+
+    Keeping the split anchored at the start means appending messages only
+    changes the last window, so earlier windows hit the chunk cache. A part
+    larger than ``max_tokens`` on its own is cut into window-sized pieces.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    windows, current, current_tokens = [], [], 0
+    for part in parts:
+        tokens = estimate_tokens(part)
+        if tokens > max_tokens:
+            if current:
+                windows.append(current)
+                current, current_tokens = [], 0
+            windows.extend([part[start:start + max_chars]] for start in range(0, len(part), max_chars))
+            continue
+        if current and current_tokens + tokens > max_tokens:
+            windows.append(current)
+            current, current_tokens = [], 0
+        current.append(part)
+        current_tokens += tokens
+    if current:
+        windows.append(current)
+    return windows
+
+def chunk_hash(model_name: str, kind: str, text: str) -> str:
+    return hashlib.sha256(f"{SUMMARY_PROMPT_VERSION}|{model_name}|{kind}|{text}".encode("utf-8")).hexdigest()
+
 class EmailGenerator:
     def __init__(self):
         self._configure_gemini()
-        self.model = genai.GenerativeModel(os.getenv("GEMINI_MODEL", "gemini-2.0-flash"))
+        self.model_name = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+        self.model = genai.GenerativeModel(self.model_name)
+
+    def _generate(self, prompt: str, call_type: str, conversation_id: Optional[int] = None,
+                  contact_id: Optional[int] = None, tenant_id: Optional[str] = None) -> str:
+        """Single entry point for model calls so every call lands in the usage ledger"""
+        with profile_phase("llm"):
+            response = usage_ledger.track(
+                lambda: self.model.generate_content(prompt),
+                call_type=call_type,
+                model=self.model_name,
+                conversation_id=conversation_id,
+                contact_id=contact_id,
+                tenant_id=tenant_id or current_tenant_id()
+            )
+        return response.text.strip()
 
     def _configure_gemini(self) -> None:
         api_key = os.getenv("GEMINI_API_KEY")
         if not api_key:
             raise ValueError("GEMINI_API_KEY environment variable is required")
-        genai.configure(api_key=api_key)
-        logger.info("Successfully initialized Gemini model")
+        # gRPC blocks the gevent hub; the REST transport goes through patched sockets
+        transport = os.getenv("GEMINI_TRANSPORT") or ("rest" if running_under_gevent() else None)
+        genai.configure(api_key=api_key, transport=transport)
+        logger.info(f"Successfully initialized Gemini model (transport={transport or 'default'})")
 
-    def generate_conversation_summary(self, messages: list) -> str:
+    def generate_conversation_summary(self, messages: list, conversation_id: Optional[int] = None,
+                                      contact_id: Optional[int] = None) -> str:
         """Generate a concise summary of the conversation history"""
         if not messages:
             return ""
         
         # Build conversation history for summarization
-        history_text = ""
+        turns = []
         for msg in sorted(messages, key=lambda m: m.sequence):
             sender = "You" if msg.direction == "sent" else "Contact"
-            history_text += f"{sender}: {msg.content}\n\n"
+            turns.append(f"{sender}: {msg.prompt_content}")
+        history_text = "\n\n".join(turns)
+        
+        if estimate_tokens(history_text) > SUMMARY_WINDOW_TOKENS:
+            # Too long for one prompt: summarize windows in parallel, then reduce
+            partials = self._summarize_windows(
+                split_into_windows(turns, SUMMARY_WINDOW_TOKENS), "conversation", conversation_id, contact_id
+            )
+            for _ in range(SUMMARY_MAX_REDUCE_ROUNDS):
+                if estimate_tokens("\n\n".join(partials)) <= SUMMARY_WINDOW_TOKENS or len(partials) <= 1:
+                    break
+                reduced = self._summarize_windows(
+                    split_into_windows(partials, SUMMARY_WINDOW_TOKENS), "summaries", conversation_id, contact_id
+                )
+                if len(reduced) >= len(partials):
+                    break  # summaries are not shrinking; another round would not converge
+                partials = reduced
+            history_text = "\n\n".join(
+                f"Part {index}: {partial}" for index, partial in enumerate(partials, start=1)
+            )
+            # Whatever the reduce left over, the final prompt stays within one window (latest parts kept)
+            history_text = history_text[-SUMMARY_WINDOW_TOKENS * CHARS_PER_TOKEN:]
         
         prompt = f"""
 Summarize this email conversation concisely in 2-3 sentences. Focus on:
@@ -115,17 +371,78 @@ Conversation:
 Summary:
 """
         
-        response = self.model.generate_content(prompt)
-        return response.text.strip()
+        return self._generate(prompt, "summary", conversation_id, contact_id)
 
-    def generate_contextual_reply(self, contact: Contact, context_summary: str, recent_messages: list, intent: str) -> str:
+    def _summarize_windows(self, windows: List[List[str]], kind: str, conversation_id: Optional[int],
+                           contact_id: Optional[int]) -> List[str]:
+        """Map step: one partial summary per window, reusing cached ones by content hash"""
+        texts = ["\n\n".join(window) for window in windows]
+        hashes = [chunk_hash(self.model_name, kind, window_text) for window_text in texts]
+        
+        cached = {
+            chunk.content_hash: chunk.summary
+            for chunk in SummaryChunk.query.filter(SummaryChunk.content_hash.in_(set(hashes))).all()
+        }
+        release_db_connection()
+        
+        for content_hash in hashes:
+            if content_hash in cached:
+                usage_ledger.record("summary_chunk", self.model_name, conversation_id, contact_id,
+                                    latency_ms=0.0, cache_hit=True, tenant_id=current_tenant_id())
+        
+        # Pool threads have no app context, so the tenant is passed along explicitly
+        pending = {
+            content_hash: summary_pool.submit(
+                self._summarize_chunk, window_text, kind, conversation_id, contact_id, current_tenant_id()
+            )
+            for content_hash, window_text in zip(hashes, texts)
+            if content_hash not in cached
+        }
+        with profile_phase("llm"):
+            fresh = {content_hash: future.result() for content_hash, future in pending.items()}
+        
+        if fresh:
+            try:
+                for content_hash, summary in fresh.items():
+                    db.session.merge(SummaryChunk(content_hash=content_hash, summary=summary))
+                db.session.commit()
+            except Exception as e:
+                # Another request cached the same window first; the summaries are still usable
+                db.session.rollback()
+                logger.warning(f"Could not cache chunk summaries: {str(e)}")
+        
+        return [cached.get(content_hash) or fresh[content_hash] for content_hash in hashes]
+
+    def _summarize_chunk(self, text: str, kind: str, conversation_id: Optional[int],
+                         contact_id: Optional[int], tenant_id: str) -> str:
+        if kind == "conversation":
+            source = "this excerpt of a longer email conversation"
+        else:
+            source = "these summaries of consecutive parts of a longer email conversation"
+        
+        prompt = f"""
+Summarize {source} in a short paragraph. Keep names, dates, decisions, commitments and open questions; drop pleasantries.
+
+Text:
+{text}
+
+Summary:
+"""
+        
+        return self._generate(prompt, "summary_chunk", conversation_id, contact_id, tenant_id)
+
+    def generate_contact_profile(self, prompt: str, contact_id: int) -> str:
+        return self._generate(prompt, "contact_profile", None, contact_id)
+
+    def generate_contextual_reply(self, contact: Contact, context_summary: str, recent_messages: list, intent: str,
+                                  conversation_id: Optional[int] = None, contact_profile: Optional[str] = None) -> str:
         """Generate reply using context summary + recent messages instead of full history"""
         
         # Get the last few messages for immediate context
         recent_context = ""
-        for msg in recent_messages[-3:]:  # Last 3 messages for immediate context
+        for msg in recent_messages[-RECENT_CONTEXT_MESSAGES:]:  # Last few messages for immediate context
             sender = "You" if msg.direction == "sent" else contact.name
-            recent_context += f"{sender}: {msg.content}\n\n"
+            recent_context += f"{sender}: {msg.prompt_content}\n\n"
         
         prompt = f"""
 You are helping compose a professional email reply in an ongoing conversation.
@@ -136,6 +453,9 @@ Contact Information:
 - Company: {contact.company or 'Not specified'}
 - Email: {contact.email or 'Not specified'}
 
+Relationship Profile (across your conversations with this contact):
+{contact_profile or 'No earlier history.'}
+
 Conversation Context Summary:
 {context_summary or 'This is the start of the conversation.'}
 
@@ -155,8 +475,7 @@ Generate a professional email response that:
 Email Response:
 """
         
-        response = self.model.generate_content(prompt)
-        return response.text.strip()
+        return self._generate(prompt, "reply", conversation_id, contact.id)
 
 # Initialize generator
 try:
@@ -179,8 +498,12 @@ def update_conversation_context(conversation: Conversation) -> str:
             # Not enough messages to summarize yet
             return ""
         
+        release_db_connection()
+        
         # Generate new summary
-        new_summary = email_generator.generate_conversation_summary(messages)
+        new_summary = email_generator.generate_conversation_summary(
+            messages, conversation_id=conversation.id, contact_id=conversation.contact_id
+        )
         
         # Update conversation
         conversation.context_summary = new_summary
@@ -194,11 +517,171 @@ def update_conversation_context(conversation: Conversation) -> str:
         logger.error(f"Error updating conversation context: {str(e)}")
         return conversation.context_summary or ""
 
+# ----------------------------
+# Hot/cold tiering (archive inactive conversations)
+# ----------------------------
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 0))  # 0 disables the background sweep
+ARCHIVE_SWEEP_INTERVAL = int(os.getenv("ARCHIVE_SWEEP_INTERVAL", 3600))
+
+def archive_conversation(conversation: Conversation) -> None:
+    """Move a conversation's messages into a single compressed archive row"""
+    if conversation.archived_at:
+        return
+    
+    release_db_connection()
+    with open_repository() as repo:
+        count = repo.archive_conversation(conversation.id)
+    db.session.refresh(conversation)
+    logger.info(f"Archived conversation {conversation.id} ({count} messages)")
+
+def unarchive_conversation(conversation: Conversation) -> None:
+    """Restore archived messages into the hot table (under fresh ids, see Repository.unarchive_conversation)"""
+    if not conversation.archived_at:
+        return
+    
+    release_db_connection()
+    with open_repository() as repo:
+        repo.unarchive_conversation(conversation.id)
+    db.session.refresh(conversation)
+    logger.info(f"Unarchived conversation {conversation.id}")
+
+def archive_inactive_conversations(days: int) -> int:
+    """Archive conversations marked 'archived' or idle for more than `days` days"""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    candidates = Conversation.query.filter(
+        Conversation.archived_at.is_(None),
+        db.or_(Conversation.status == "archived", Conversation.updated_at < cutoff)
+    ).all()
+    
+    archived = 0
+    for conversation in candidates:
+        try:
+            archive_conversation(conversation)
+            archived += 1
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error archiving conversation {conversation.id}: {str(e)}")
+    return archived
+
+def run_archive_sweeper() -> None:
+    while True:
+        time.sleep(ARCHIVE_SWEEP_INTERVAL)
+        try:
+            results = fan_out_tenants(lambda tenant_id: archive_inactive_conversations(ARCHIVE_AFTER_DAYS))
+            count = sum(outcome.get("result", 0) for outcome in results.values())
+            if count:
+                logger.info(f"Archive sweep moved {count} conversations to cold storage")
+        except Exception as e:
+            logger.error(f"Archive sweep failed: {str(e)}")
+
+# ----------------------------
+# Admission control (keeps CRUD and health endpoints responsive during LLM brownouts)
+# ----------------------------
+# Both classes block on Gemini; they get separate slots so a burst of reply
+# generations cannot starve plain message inserts (which only wait on the summary).
+generation_limiter = limiter_from_env("generation", default_concurrency=4, default_queue=8)
+summary_limiter = limiter_from_env("summary", default_concurrency=8, default_queue=16)
+
 # ----------------------------
 # DB bootstrap
 # ----------------------------
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    # Same pragmas as every other connection to these files (WAL, foreign keys, busy timeout)
+    configure_connection(dbapi_connection)
+
+def open_tenant_engine(path: str):
+    """Engine for one tenant shard, created and migrated on first use"""
+    engine = create_engine(f"sqlite:///{path}", **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    event.listen(engine, "connect", set_sqlite_pragmas)
+    profiler.instrument_engine(engine)
+    conn = engine.raw_connection()
+    try:
+        migrate_schema(conn)
+    finally:
+        conn.close()
+    return engine
+
+def fan_out_tenants(call) -> Dict[str, Dict[str, Any]]:
+    """Run ``call(tenant_id)`` bound to every tenant's database, the default one included"""
+    def run(tenant_id: str, engine) -> Any:
+        with app.app_context():
+            g.tenant_id = tenant_id
+            g.tenant_engine = engine
+            try:
+                return call(tenant_id)
+            finally:
+                db.session.remove()
+    
+    try:
+        results = {DEFAULT_TENANT: {"result": run(DEFAULT_TENANT, None)}}
+    except Exception as e:
+        logger.error(f"Fan-out failed for the default database: {str(e)}")
+        results = {DEFAULT_TENANT: {"error": str(e)}}
+    if shard_router is not None:
+        results.update(shard_router.fan_out(run, [t for t in shard_router.tenants() if t != DEFAULT_TENANT]))
+    return results
+
+def run_compression_backfill() -> None:
+    """Background migration: compress message bodies written before compression existed.
+
+    Every worker starts it; the first to claim the task in maintenance_tasks
+    does the work and the rest return at once.
+    """
+    with app.app_context():
+        conn = db.engine.raw_connection()
+        try:
+            backfill_compression(conn, ConversationMessage.__tablename__)
+        except Exception as e:
+            logger.error(f"Compression backfill failed: {str(e)}")
+        finally:
+            conn.close()
+
 with app.app_context():
-    db.create_all()
+    if db.engine.dialect.name == "sqlite":
+        event.listen(db.engine, "connect", set_sqlite_pragmas)
+    profiler.instrument_engine(db.engine)
+    # The schema is owned by repository.py's versioned migrations (shared with
+    # conversation_app.py); the models above map onto those tables
+    schema_conn = db.engine.raw_connection()
+    try:
+        migrate_schema(schema_conn)
+    finally:
+        schema_conn.close()
+    
+    # Per-tenant shards: requests carrying TENANT_HEADER get their own SQLite file
+    shard_router = None
+    if SHARD_DIR:
+        if db.engine.dialect.name != "sqlite":
+            raise RuntimeError("TENANT_SHARD_DIR requires a SQLite DATABASE_URL")
+        shard_router = ShardRouter(SHARD_DIR, open_tenant_engine, lambda engine: engine.dispose())
+
+@app.before_request
+def bind_tenant_shard():
+    if shard_router is None:
+        return None
+    try:
+        tenant_id = validate_tenant(request.headers.get(TENANT_HEADER))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if tenant_id != DEFAULT_TENANT:
+        g.tenant_id = tenant_id
+        g.tenant_engine = shard_router.acquire(tenant_id)
+    return None
+
+@app.teardown_request
+def release_tenant_shard(exc) -> None:
+    if g.get("tenant_engine") is None:
+        return
+    # Return the session's connection before the shard can be evicted
+    db.session.remove()
+    g.tenant_engine = None
+    shard_router.release(g.tenant_id)
+
+if os.getenv("MESSAGE_COMPRESSION_BACKFILL", "1") == "1":
+    threading.Thread(target=run_compression_backfill, name="compression-backfill", daemon=True).start()
+
+if ARCHIVE_AFTER_DAYS > 0:
+    threading.Thread(target=run_archive_sweeper, name="archive-sweeper", daemon=True).start()
 
 # ----------------------------
 # Routes - Pages (same as before)
@@ -264,17 +747,18 @@ def contacts():
     
     # GET: list contacts
     try:
-        contacts = Contact.query.all()
+        with open_repository() as repo:
+            contacts = repo.list_contacts()
         result = []
         for contact in contacts:
             result.append({
-                "id": contact.id,
-                "name": contact.name,
-                "email": contact.email,
-                "designation": contact.designation,
-                "company": contact.company,
-                "created_at": contact.created_at.isoformat(),
-                "conversation_count": len(contact.conversations)
+                "id": contact["id"],
+                "name": contact["name"],
+                "email": contact["email"],
+                "designation": contact["designation"],
+                "company": contact["company"],
+                "created_at": contact["created_at"],
+                "conversation_count": contact["conversation_count"]
             })
         return jsonify(result)
     except Exception as e:
@@ -319,65 +803,110 @@ def conversations_api():
             logger.error(f"Error creating conversation: {str(e)}")
             return jsonify({"error": str(e)}), 500
     
-    # GET: list conversations (same as before)
+    # GET: list conversations (archived ones only on request)
     try:
-        conversations = db.session.query(Conversation).join(Contact).all()
+        include_archived = request.args.get("include_archived") == "1"
+        with open_repository() as repo:
+            conversations = repo.list_conversations(include_archived=include_archived)
         result = []
         for conversation in conversations:
-            last_message = ConversationMessage.query.filter_by(
-                conversation_id=conversation.id
-            ).order_by(ConversationMessage.sequence.desc()).first()
-            
+            preview = conversation["last_message"]
+            context_summary = conversation["context_summary"]
             result.append({
-                "id": conversation.id,
-                "title": conversation.title,
-                "status": conversation.status,
-                "contact_name": conversation.contact.name,
-                "contact_company": conversation.contact.company,
-                "created_at": conversation.created_at.isoformat(),
-                "updated_at": conversation.updated_at.isoformat(),
-                "message_count": len(conversation.messages),
-                "last_message": last_message.content[:100] + "..." if last_message else "No messages",
-                "context_summary": conversation.context_summary[:150] + "..." if conversation.context_summary else "No context yet"
+                "id": conversation["id"],
+                "title": conversation["title"],
+                "status": conversation["status"],
+                "archived": conversation["archived"],
+                "contact_name": conversation["contact_name"],
+                "contact_company": conversation["contact_company"],
+                "created_at": conversation["created_at"],
+                "updated_at": conversation["updated_at"],
+                "message_count": conversation["message_count"],
+                "last_message": preview + "..." if preview else "No messages",
+                "context_summary": context_summary[:150] + "..." if context_summary else "No context yet"
             })
         return jsonify(result)
     except Exception as e:
         logger.error(f"Error listing conversations: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+MAX_PAGE_SIZE = 500
+
+def conversation_etag(conversation_id: int, latest_sequence: Optional[int], updated_at: Optional[str],
+                      archived: bool, args) -> str:
+    """Version tag of one representation: thread state plus the paging arguments"""
+    version = f"{conversation_id}:{latest_sequence}:{updated_at}:{archived}:{sorted(args.items())}"
+    return hashlib.sha1(version.encode("utf-8")).hexdigest()[:20]
+
+def parse_optional_int(name: str) -> Optional[int]:
+    value = request.args.get(name)
+    return int(value) if value not in (None, "") else None
+
 @app.route("/api/conversations/<int:conversation_id>", methods=["GET"])
 def get_conversation(conversation_id):
+    """Conversation with its messages.
+
+    Supports If-None-Match (304 when unchanged), ``since_sequence`` (delta of
+    newer messages) and ``before_sequence``/``limit`` cursor pagination.
+    """
     try:
-        conversation = Conversation.query.get_or_404(conversation_id)
-        messages = ConversationMessage.query.filter_by(
-            conversation_id=conversation_id
-        ).order_by(ConversationMessage.sequence).all()
+        try:
+            since_sequence = parse_optional_int("since_sequence")
+            before_sequence = parse_optional_int("before_sequence")
+            limit = parse_optional_int("limit")
+        except ValueError:
+            return jsonify({"error": "since_sequence, before_sequence and limit must be integers"}), 400
+        if limit is not None:
+            limit = max(1, min(limit, MAX_PAGE_SIZE))
+        
+        with open_repository() as repo:
+            # Cheap validator read: one row, no message bodies
+            header = repo.get_conversation(conversation_id)
+            if header is None:
+                return jsonify({"error": "Conversation not found"}), 404
+            
+            archived = header["archived"]
+            etag = conversation_etag(conversation_id, header["latest_sequence"], header["updated_at"],
+                                     archived, request.args)
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+            
+            if archived:
+                # Cold tier: rehydrate from the archive blob without restoring rows
+                messages, _ = repo.get_messages(conversation_id, archived=True)
+                latest_sequence = messages[-1]["sequence"] if messages else None
+                messages, has_more = Repository._page(messages, since_sequence, before_sequence, limit)
+            else:
+                latest_sequence = header["latest_sequence"]
+                messages, has_more = repo.get_messages(
+                    conversation_id, since_sequence=since_sequence, before_sequence=before_sequence, limit=limit,
+                    archived=False
+                )
         
         result = {
-            "id": conversation.id,
-            "title": conversation.title,
-            "status": conversation.status,
-            "context_summary": conversation.context_summary,  # Include context summary
-            "contact": {
-                "id": conversation.contact.id,
-                "name": conversation.contact.name,
-                "email": conversation.contact.email,
-                "designation": conversation.contact.designation,
-                "company": conversation.contact.company
-            },
+            "id": header["id"],
+            "title": header["title"],
+            "status": header["status"],
+            "archived": archived,
+            "context_summary": header["context_summary"],  # Include context summary
+            "contact": header["contact"],
             "messages": []
         }
-        
         for message in messages:
-            result["messages"].append({
-                "id": message.id,
-                "content": message.content,
-                "direction": message.direction,
-                "sequence": message.sequence,
-                "created_at": message.created_at.isoformat()
-            })
-            
-        return jsonify(result)
+            message.pop("conversation_id", None)
+        
+        result["messages"] = messages
+        result["latest_sequence"] = latest_sequence
+        result["has_more"] = has_more
+        if has_more and messages and since_sequence is None:
+            result["next_before_sequence"] = messages[0]["sequence"]
+        
+        response = jsonify(result)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
     except Exception as e:
         logger.error(f"Error getting conversation {conversation_id}: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -385,7 +914,9 @@ def get_conversation(conversation_id):
 # ----------------------------
 # API Routes - Enhanced Messages with Context Update
 # ----------------------------
+
 @app.route("/api/conversations/<int:conversation_id>/messages", methods=["POST"])
+@admission_controlled(summary_limiter)
 def add_message(conversation_id):
     try:
         conversation = Conversation.query.get_or_404(conversation_id)
@@ -397,39 +928,32 @@ def add_message(conversation_id):
         if not content or direction not in ["sent", "received"]:
             return jsonify({"error": "Invalid content or direction"}), 400
         
-        # Get next sequence number
-        last_message = ConversationMessage.query.filter_by(
-            conversation_id=conversation_id
-        ).order_by(ConversationMessage.sequence.desc()).first()
+        # New activity brings an archived thread back to the hot tier
+        unarchive_conversation(conversation)
         
-        next_sequence = (last_message.sequence + 1) if last_message else 1
+        release_db_connection()
         
-        message = ConversationMessage(
-            conversation_id=conversation_id,
-            content=content,
-            direction=direction,
-            sequence=next_sequence
-        )
-        
-        db.session.add(message)
-        conversation.updated_at = datetime.utcnow()
-        db.session.commit()
+        # Quoted history / repeated signatures are stripped at ingestion so prompts only see novel text
+        message = store_message(conversation_id, content, direction)
         
         # 🧠 Update context summary after adding message
         update_conversation_context(conversation)
         
         logger.info(f"Message added to conversation {conversation_id}: {direction}")
         return jsonify({
-            "id": message.id,
-            "content": message.content,
-            "direction": message.direction,
-            "sequence": message.sequence
+            "id": message["id"],
+            "content": message["content"],
+            "clean_content": message["clean_content"],
+            "quoted_message_id": message["quoted_message_id"],
+            "direction": message["direction"],
+            "sequence": message["sequence"]
         })
     except Exception as e:
         logger.error(f"Error adding message: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/conversations/<int:conversation_id>/generate-reply", methods=["POST"])
+@admission_controlled(generation_limiter)
 def generate_reply(conversation_id):
     try:
         conversation = Conversation.query.get_or_404(conversation_id)
@@ -439,32 +963,39 @@ def generate_reply(conversation_id):
         if not intent:
             return jsonify({"error": "Missing intent"}), 400
         
+        unarchive_conversation(conversation)
+        
         # Get recent messages for immediate context
-        recent_messages = ConversationMessage.query.filter_by(
+        recent_messages = list(reversed(ConversationMessage.query.filter_by(
             conversation_id=conversation_id
-        ).order_by(ConversationMessage.sequence).all()
+        ).order_by(ConversationMessage.sequence.desc()).limit(RECENT_CONTEXT_MESSAGES).all()))
+        
+        contact = conversation.contact
+        with open_repository() as repo:
+            profile_sources = repo.contact_profile_sources(contact.id, PROFILE_MAX_CONVERSATIONS)
+        release_db_connection()
+        
+        # Cross-thread profile; only regenerated when the notes or another thread's summary changed
+        profile, source_digests = refresh_contact_profile(
+            profile_sources, lambda prompt: email_generator.generate_contact_profile(prompt, contact.id),
+            active_conversation_id=conversation_id
+        )
+        if source_digests:
+            with open_repository() as repo:
+                repo.save_contact_profile(contact.id, profile, source_digests)
         
         # 🧠 Generate reply using context summary + recent messages
         reply = email_generator.generate_contextual_reply(
-            conversation.contact, 
+            contact, 
             conversation.context_summary,
             recent_messages, 
-            intent
-        )
-        
-        # Save reply as a message
-        next_sequence = (recent_messages[-1].sequence + 1) if recent_messages else 1
-        
-        message = ConversationMessage(
+            intent,
             conversation_id=conversation_id,
-            content=reply,
-            direction="sent",
-            sequence=next_sequence
+            contact_profile=compact_profile(profile)
         )
         
-        db.session.add(message)
-        conversation.updated_at = datetime.utcnow()
-        db.session.commit()
+        # Save reply as a message (model output, nothing to strip)
+        message = store_message(conversation_id, reply, "sent", normalize=False)
         
         # 🧠 Update context summary after generating reply
         update_conversation_context(conversation)
@@ -472,14 +1003,142 @@ def generate_reply(conversation_id):
         logger.info(f"Reply generated for conversation {conversation_id} using context summary")
         return jsonify({
             "reply": reply,
-            "message_id": message.id,
-            "sequence": message.sequence,
+            "message_id": message["id"],
+            "sequence": message["sequence"],
             "context_updated": True
         })
     except Exception as e:
         logger.error(f"Error generating reply: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+# ----------------------------
+# API Routes - Archive
+# ----------------------------
+@app.route("/api/conversations/<int:conversation_id>/archive", methods=["POST"])
+def archive_conversation_api(conversation_id):
+    try:
+        conversation = Conversation.query.get_or_404(conversation_id)
+        conversation.status = "archived"
+        db.session.commit()
+        archive_conversation(conversation)
+        return jsonify({"id": conversation.id, "status": conversation.status, "archived": True})
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error archiving conversation {conversation_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/conversations/<int:conversation_id>/unarchive", methods=["POST"])
+def unarchive_conversation_api(conversation_id):
+    try:
+        conversation = Conversation.query.get_or_404(conversation_id)
+        unarchive_conversation(conversation)
+        return jsonify({"id": conversation.id, "status": conversation.status, "archived": False})
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error unarchiving conversation {conversation_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+ADMIN_HEADER = "X-Admin-Token"
+
+def admin_authorized() -> bool:
+    """Cross-tenant admin endpoints accept X-Admin-Token = ADMIN_TOKEN (or the profiling token)"""
+    supplied = request.headers.get(ADMIN_HEADER)
+    if ADMIN_TOKEN and supplied and hmac.compare_digest(supplied, ADMIN_TOKEN):
+        return True
+    return profiler.authorized()
+
+@app.route("/api/admin/archive", methods=["POST"])
+def archive_sweep_api():
+    if not admin_authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    try:
+        data = request.get_json(silent=True) or {}
+        days = int(data.get("days", ARCHIVE_AFTER_DAYS or 90))
+        results = fan_out_tenants(lambda tenant_id: archive_inactive_conversations(days))
+        archived = sum(outcome.get("result", 0) for outcome in results.values())
+        return jsonify({"archived": archived, "days": days, "tenants": results})
+    except Exception as e:
+        logger.error(f"Error running archive sweep: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+# ----------------------------
+# Admin - LLM usage
+# ----------------------------
+@app.route("/api/usage/report", methods=["GET"])
+def usage_report_api():
+    usage_ledger.flush()
+    conn = db.engine.raw_connection()
+    try:
+        days = int(request.args.get("days", 30))
+        # Admins see every tenant; anyone else only the tenant of their request
+        tenant_id = request.args.get("tenant") if admin_authorized() else current_tenant_id()
+        return jsonify(usage_report(profiled_connection(conn), days, tenant_id))
+    except Exception as e:
+        logger.error(f"Error building usage report: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+# ----------------------------
+# Admin - Profiling
+# ----------------------------
+@app.route("/api/admin/profiles", methods=["GET"])
+def list_profiles_api():
+    if not profiler.authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(profiler.list_profiles())
+
+@app.route("/api/admin/profiles/<name>", methods=["GET"])
+def get_profile_api(name):
+    if not profiler.authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    path = profiler.artifact_path(name)
+    if not path:
+        return jsonify({"error": "Profile not found"}), 404
+    return send_file(path, as_attachment=True, download_name=name)
+
+# ----------------------------
+# Admin - Storage
+# ----------------------------
+@app.route("/api/admin/storage-report", methods=["GET"])
+def storage_report_api():
+    if not admin_authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    conn = current_engine().raw_connection()
+    try:
+        return jsonify(storage_report(profiled_connection(conn), ConversationMessage.__tablename__))
+    except Exception as e:
+        logger.error(f"Error building storage report: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+# ----------------------------
+# Admin - Tenant shards
+# ----------------------------
+def shard_stats(tenant_id: str) -> Dict[str, Any]:
+    path = db.engine.url.database if tenant_id == DEFAULT_TENANT else shard_router.shard_path(tenant_id)
+    return {
+        "conversations": Conversation.query.count(),
+        "messages": ConversationMessage.query.count(),
+        "size_bytes": os.path.getsize(path) if path and os.path.exists(path) else None,
+    }
+
+@app.route("/api/admin/shards", methods=["GET"])
+def shards_api():
+    if not admin_authorized():
+        return jsonify({"error": "Forbidden"}), 403
+    try:
+        return jsonify({
+            "sharding": shard_router is not None,
+            "pool": shard_router.snapshot() if shard_router is not None else None,
+            "tenants": fan_out_tenants(shard_stats),
+        })
+    except Exception as e:
+        logger.error(f"Error listing shards: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 # ----------------------------
 # Health check
 # ----------------------------
@@ -487,7 +1146,13 @@ def generate_reply(conversation_id):
 def healthz():
     return jsonify({
         "status": "ok", 
-        "time": datetime.utcnow().isoformat()
+        "time": datetime.utcnow().isoformat(),
+        "admission": {
+            "generation": generation_limiter.snapshot(),
+            "summary": summary_limiter.snapshot()
+        },
+        "shards": shard_router.snapshot() if shard_router is not None else None,
+        "ingest": writer_stats()
     })
 
 if __name__ == "__main__":
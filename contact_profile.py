@@ -0,0 +1,90 @@
+import os
+import re
+import hashlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# ----------------------------
+# Contact-level relationship profile
+# ----------------------------
+# A short profile per contact, distilled from the context summaries of that
+# contact's threads plus Contact.notes. It is stored once per contact with a
+# digest of each input (the notes and every member thread's summary) and only
+# recomputed when one of them changes, so reply prompts get cross-thread
+# context without replaying other threads.
+# The thread being replied to is ignored when comparing digests: its summary is
+# already in the reply prompt and is rewritten after every message, which would
+# otherwise force a profile regeneration on nearly every reply.
+
+PROFILE_MAX_CONVERSATIONS = int(os.getenv("CONTACT_PROFILE_MAX_CONVERSATIONS", 20))
+PROFILE_PROMPT_CHARS = int(os.getenv("CONTACT_PROFILE_PROMPT_CHARS", 800))
+PROFILE_PROMPT_VERSION = "1"  # bump when the prompt changes to rebuild stored profiles
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def source_digests(notes: Optional[str], summaries: List[Tuple[int, str, str]]) -> Dict[str, str]:
+    """Digest of each input a profile is derived from: "notes" plus one per member thread id"""
+    digests = {"notes": _digest(f"{PROFILE_PROMPT_VERSION}|{notes or ''}")}
+    for conversation_id, _, summary in summaries:
+        digests[str(conversation_id)] = _digest(summary)
+    return digests
+
+
+def _without(digests: Dict[str, str], conversation_id: Optional[int]) -> Dict[str, str]:
+    return {key: value for key, value in digests.items() if key != str(conversation_id)}
+
+
+def build_profile_prompt(name: str, notes: Optional[str], summaries: List[Tuple[int, str, str]]) -> str:
+    threads = "\n\n".join(f"Thread \"{title}\":\n{summary}" for _, title, summary in summaries)
+    return f"""
+Write a relationship profile of {name} for someone about to email them, based on the notes and conversation summaries below.
+In at most 5 short bullet points cover: who they are and what they care about, the history and current state of your dealings across these threads, open commitments on either side, and tone/preferences to respect. Use only facts stated below.
+
+Notes:
+{notes or 'None'}
+
+Conversation summaries (most recent first):
+{threads}
+
+Profile:
+"""
+
+
+def compact_profile(profile: Optional[str], limit: int = PROFILE_PROMPT_CHARS) -> Optional[str]:
+    """Whitespace-collapsed profile cut at a word boundary, sized for a reply prompt"""
+    if not profile:
+        return None
+    profile = re.sub(r"[ \t]+", " ", re.sub(r"\n\s*\n+", "\n", profile)).strip()
+    if len(profile) <= limit:
+        return profile
+    return profile[:limit].rsplit(" ", 1)[0] + "..."
+
+
+def refresh_contact_profile(sources: Optional[Dict[str, Any]], generate: Callable[[str], str],
+                            active_conversation_id: Optional[int] = None
+                            ) -> Tuple[Optional[str], Optional[Dict[str, str]]]:
+    """Return (profile, digests to store or None when the stored profile is current).
+
+    ``sources`` is Repository.contact_profile_sources(); ``generate`` runs the
+    LLM call and is only invoked when the notes or the summary of a thread
+    other than ``active_conversation_id`` changed (or a thread joined or left
+    the contact's most recent ones). A regenerated profile covers every thread,
+    the active one included. A contact with notes but no summarized threads
+    uses the notes as-is.
+    """
+    if sources is None:
+        return None, None
+
+    digests = source_digests(sources["notes"], sources["summaries"])
+    stored = sources["profile_source_digests"]
+    if (sources["profile_summary"] is not None and stored is not None
+            and _without(stored, active_conversation_id) == _without(digests, active_conversation_id)):
+        return sources["profile_summary"], None
+
+    if sources["summaries"]:
+        profile = generate(build_profile_prompt(sources["name"], sources["notes"], sources["summaries"]))
+    else:
+        profile = (sources["notes"] or "").strip()
+    return profile, digests
@@ -4,6 +4,19 @@ import datetime
 from typing import List, Dict
 import google.generativeai as genai
 import os
+import logging
+import threading
+from contextlib import contextmanager
+
+import repository
+from repository import Repository
+from contact_profile import refresh_contact_profile, compact_profile, PROFILE_MAX_CONVERSATIONS
+from ingest_queue import get_writer
+from sharding import ShardRouter, validate_tenant, SHARD_DIR
+from message_codec import backfill_compression
+from usage_ledger import UsageLedger, LEDGER_TABLE
+
+logger = logging.getLogger(__name__)
 
 # Configure Streamlit
 st.set_page_config(
@@ -13,6 +26,8 @@ st.set_page_config(
 )
 
 # Configure Gemini AI
+MODEL_NAME = "gemini-2.0-flash"
+
 @st.cache_resource
 def setup_ai():
     api_key = os.getenv("GEMINI_API_KEY")
@@ -21,58 +36,77 @@ def setup_ai():
         st.stop()
     
     genai.configure(api_key=api_key)
-    return genai.GenerativeModel("gemini-2.0-flash")
+    return genai.GenerativeModel(MODEL_NAME)
 
 model = setup_ai()
 
-# Database setup
+# Database setup (schema and queries live in repository.py, shared with app.py)
+DB_PATH = '/tmp/conversations.db'
+
+def compress_existing_messages():
+    # Background migration on its own connection so the UI connection is never shared across threads
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        backfill_compression(conn, "conversation_messages")
+    except Exception as e:
+        logger.error(f"Compression backfill failed: {str(e)}")
+    finally:
+        conn.close()
+
 @st.cache_resource
 def init_database():
-    db_path = '/tmp/conversations.db'
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    conn.execute('PRAGMA foreign_keys = ON')
-    
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS contacts (
-            id INTEGER PRIMARY KEY,
-            name TEXT NOT NULL,
-            email TEXT DEFAULT '',
-            designation TEXT DEFAULT '',
-            company TEXT DEFAULT '',
-            notes TEXT DEFAULT '',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS conversations (
-            id INTEGER PRIMARY KEY,
-            contact_id INTEGER NOT NULL,
-            title TEXT NOT NULL,
-            status TEXT DEFAULT 'active',
-            context_summary TEXT DEFAULT '',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (contact_id) REFERENCES contacts (id) ON DELETE CASCADE
-        )
-    ''')
-    
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY,
-            conversation_id INTEGER NOT NULL,
-            content TEXT NOT NULL,
-            direction TEXT NOT NULL CHECK (direction IN ('sent', 'received')),
-            sequence INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+    conn = repository.connect(DB_PATH)
+    threading.Thread(target=compress_existing_messages, daemon=True).start()
+    return Repository(conn)
+
+repo = init_database()
+
+# Per-tenant shards (TENANT_SHARD_DIR set): ?tenant=<id> picks the workspace's own SQLite file
+def open_tenant_repository(path):
+    return Repository(repository.connect(path))
+
+@st.cache_resource
+def init_shard_router():
+    if not SHARD_DIR:
+        return None
+    return ShardRouter(SHARD_DIR, open_tenant_repository, lambda r: r.conn.close(), default_path=DB_PATH)
+
+shard_router = init_shard_router()
+
+try:
+    current_tenant = validate_tenant(st.experimental_get_query_params().get("tenant", [None])[0])
+except ValueError as e:
+    st.error(str(e))
+    st.stop()
+
+@contextmanager
+def tenant_repository():
+    if shard_router is None:
+        yield repo
+        return
+    with shard_router.lease(current_tenant) as shard_repo:
+        yield shard_repo
+
+def write_usage_batch(rows):
+    # Runs on the ledger thread, so it uses its own connection
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        conn.executemany(
+            f"INSERT INTO {LEDGER_TABLE} (created_at, source, tenant_id, call_type, model, conversation_id, "
+            "contact_id, prompt_tokens, response_tokens, latency_ms, cache_hit, error) "
+            "VALUES (:created_at, :source, :tenant_id, :call_type, :model, :conversation_id, :contact_id, "
+            ":prompt_tokens, :response_tokens, :latency_ms, :cache_hit, :error)",
+            rows
         )
-    ''')
-    
-    conn.commit()
-    return conn
+        conn.commit()
+    finally:
+        conn.close()
+
+@st.cache_resource
+def init_usage_ledger():
+    return UsageLedger(write_usage_batch, source="streamlit")
 
-db = init_database()
+usage_ledger = init_usage_ledger()
 
 # Minimal CSS (Only for chat bubbles)
 st.markdown("""
@@ -109,90 +143,97 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# Helper functions
+# Helper functions (return the tuple shapes the pages below unpack)
 def add_contact(name, email="", designation="", company="", notes=""):
-    cursor = db.execute(
-        "INSERT INTO contacts (name, email, designation, company, notes) VALUES (?, ?, ?, ?, ?)",
-        (name, email or "", designation or "", company or "", notes or "")
-    )
-    db.commit()
-    return cursor.lastrowid
+    with tenant_repository() as repo:
+        return repo.add_contact(name, email, designation, company, notes)
 
 def get_contacts():
-    return db.execute(
-        "SELECT id, name, email, designation, company, notes, created_at FROM contacts ORDER BY name"
-    ).fetchall()
+    with tenant_repository() as repo:
+        contacts = repo.list_contacts()
+    return [
+        (c["id"], c["name"], c["email"], c["designation"], c["company"], c["notes"], c["created_at"])
+        for c in contacts
+    ]
 
 def get_contact(contact_id):
-    return db.execute(
-        "SELECT id, name, email, designation, company, notes, created_at FROM contacts WHERE id = ?", 
-        (contact_id,)
-    ).fetchone()
+    with tenant_repository() as repo:
+        c = repo.get_contact(contact_id)
+    if not c:
+        return None
+    return (c["id"], c["name"], c["email"], c["designation"], c["company"], c["notes"], c["created_at"])
 
 def get_conversations_for_contact(contact_id):
-    return db.execute("""
-        SELECT c.id, c.contact_id, c.title, c.status, c.context_summary, 
-               c.created_at, c.updated_at, COUNT(m.id) as message_count,
-               MAX(m.created_at) as last_message_time
-        FROM conversations c
-        LEFT JOIN messages m ON c.id = m.conversation_id
-        WHERE c.contact_id = ?
-        GROUP BY c.id, c.contact_id, c.title, c.status, c.context_summary, c.created_at, c.updated_at
-        ORDER BY c.updated_at DESC
-    """, (contact_id,)).fetchall()
+    with tenant_repository() as repo:
+        conversations = repo.list_conversations(contact_id=contact_id, include_archived=True)
+    return [
+        (c["id"], c["contact_id"], c["title"], c["status"], c["context_summary"],
+         c["created_at"], c["updated_at"], c["message_count"], c["last_message_time"])
+        for c in conversations
+    ]
 
 def add_conversation(contact_id, title):
-    cursor = db.execute(
-        "INSERT INTO conversations (contact_id, title) VALUES (?, ?)",
-        (contact_id, title)
-    )
-    db.commit()
-    return cursor.lastrowid
+    with tenant_repository() as repo:
+        return repo.add_conversation(contact_id, title)
 
 def get_conversation(conversation_id):
-    return db.execute("""
-        SELECT c.id, c.contact_id, c.title, c.status, c.context_summary, 
-               c.created_at, c.updated_at, ct.name, ct.email, ct.designation, ct.company
-        FROM conversations c
-        JOIN contacts ct ON c.contact_id = ct.id
-        WHERE c.id = ?
-    """, (conversation_id,)).fetchone()
+    with tenant_repository() as repo:
+        c = repo.get_conversation(conversation_id)
+    if not c:
+        return None
+    contact = c["contact"]
+    return (c["id"], c["contact_id"], c["title"], c["status"], c["context_summary"],
+            c["created_at"], c["updated_at"], contact["name"], contact["email"],
+            contact["designation"], contact["company"])
 
 def add_message(conversation_id, content, direction):
-    result = db.execute(
-        "SELECT MAX(sequence) FROM messages WHERE conversation_id = ?", 
-        (conversation_id,)
-    ).fetchone()
-    next_seq = (result[0] or 0) + 1
-    
-    cursor = db.execute(
-        "INSERT INTO messages (conversation_id, content, direction, sequence) VALUES (?, ?, ?, ?)",
-        (conversation_id, content, direction, next_seq)
-    )
-    
-    db.execute(
-        "UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-        (conversation_id,)
-    )
-    
-    db.commit()
-    return cursor.lastrowid
+    # Group commit shared with every other session writing to this database file
+    db_path = shard_router.shard_path(current_tenant) if shard_router is not None else DB_PATH
+    return get_writer(db_path).add_message(conversation_id, content, direction)["id"]
 
 def get_messages(conversation_id):
-    return db.execute(
-        "SELECT id, conversation_id, content, direction, sequence, created_at FROM messages WHERE conversation_id = ? ORDER BY sequence",
-        (conversation_id,)
-    ).fetchall()
+    with tenant_repository() as repo:
+        messages, _ = repo.get_messages(conversation_id)
+    return [
+        (m["id"], m["conversation_id"], m["content"], m["direction"], m["sequence"], m["created_at"])
+        for m in messages
+    ]
+
+def get_recent_prompt_messages(conversation_id, limit=5):
+    # Prompts use the cleaned body (quotes/signatures stripped) when one was stored
+    with tenant_repository() as repo:
+        return repo.recent_prompt_messages(conversation_id, limit)
+
+def get_contact_profile(contact_id, conversation_id):
+    """Stored profile of the contact, regenerated only when the notes or another thread's summary changed"""
+    with tenant_repository() as repo:
+        sources = repo.contact_profile_sources(contact_id, PROFILE_MAX_CONVERSATIONS)
+    
+    def generate(prompt):
+        response = usage_ledger.track(
+            lambda: model.generate_content(prompt),
+            call_type="contact_profile",
+            model=MODEL_NAME,
+            contact_id=contact_id,
+            tenant_id=current_tenant
+        )
+        return response.text.strip()
+    
+    profile, source_digests = refresh_contact_profile(sources, generate, active_conversation_id=conversation_id)
+    if source_digests:
+        with tenant_repository() as repo:
+            repo.save_contact_profile(contact_id, profile, source_digests)
+    return compact_profile(profile)
 
 def generate_ai_reply_content(conversation_id, intent):
     conv = get_conversation(conversation_id)
-    messages = get_messages(conversation_id)
+    messages = get_recent_prompt_messages(conversation_id)
     
     conv_id, contact_id, title, status, context_summary, created_at, updated_at, contact_name, email, designation, company = conv
+    contact_profile = get_contact_profile(contact_id, conversation_id)
     
     recent_context = ""
-    for msg in messages[-5:]:
-        msg_id, conv_id, content, direction, sequence, msg_created_at = msg
+    for direction, content in messages:
         sender = "You" if direction == "sent" else contact_name
         recent_context += f"{sender}: {content}\n\n"
     
@@ -204,6 +245,9 @@ Contact Information:
 - Role: {designation or 'Not specified'}
 - Company: {company or 'Not specified'}
 
+Relationship Profile (across your conversations with this contact):
+{contact_profile or 'No earlier history.'}
+
 Recent Exchange:
 {recent_context}
 
@@ -220,7 +264,14 @@ Generate a professional email response that:
 Email Response:
 """
     
-    response = model.generate_content(prompt)
+    response = usage_ledger.track(
+        lambda: model.generate_content(prompt),
+        call_type="reply",
+        model=MODEL_NAME,
+        conversation_id=conversation_id,
+        contact_id=contact_id,
+        tenant_id=current_tenant
+    )
     return response.text.strip()
 
 # Initialize session state
@@ -0,0 +1,151 @@
+import re
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+# ----------------------------
+# Ingestion-time normalization of pasted emails
+# ----------------------------
+# Pasted replies usually carry the whole prior thread. We keep the original
+# body for display and store a cleaned copy (novel text only) for prompts.
+
+REPLY_HEADER_PATTERNS = [
+    re.compile(r"^\s*On\b.{0,300}\bwrote:\s*$", re.IGNORECASE),
+    re.compile(r"^\s*-{2,}\s*Original Message\s*-{2,}\s*$", re.IGNORECASE),
+    re.compile(r"^\s*_{10,}\s*$"),  # Outlook separator line
+]
+FORWARD_HEADER_PATTERNS = [
+    re.compile(r"^\s*-{2,}\s*Forwarded message\s*-{2,}\s*$", re.IGNORECASE),
+    re.compile(r"^\s*Begin forwarded message:\s*$", re.IGNORECASE),
+]
+HEADER_FIELD = re.compile(r"^\s*\*?(From|Sent|Date|To|Cc|Subject|Reply-To)\*?:\s*", re.IGNORECASE)
+SIGNATURE_DELIMITER = re.compile(r"^-- ?$")
+
+MIN_SIGNATURE_LINES = 2
+MAX_SIGNATURE_LINES = 12
+
+
+class CleanedEmail(NamedTuple):
+    body: str  # novel text to feed prompts
+    quoted: str  # text removed as quoted history
+    signature: str  # text removed as signature
+
+
+def _is_reply_header(lines: List[str], index: int) -> bool:
+    line = lines[index]
+    if any(p.match(line) for p in REPLY_HEADER_PATTERNS):
+        return True
+    # "On <date>, <name> <addr>" is often wrapped before "wrote:"
+    if index + 1 < len(lines) and re.match(r"^\s*On\b", line, re.IGNORECASE):
+        joined = f"{line} {lines[index + 1].strip()}"
+        if REPLY_HEADER_PATTERNS[0].match(joined):
+            return True
+    # Outlook-style block: From: followed closely by Sent:/Date: and To:/Subject:
+    if re.match(r"^\s*\*?From\*?:", line, re.IGNORECASE):
+        following = [l for l in lines[index + 1:index + 6] if HEADER_FIELD.match(l)]
+        return len(following) >= 2
+    return False
+
+
+def _skip_header_block(lines: List[str], index: int) -> int:
+    while index < len(lines) and (HEADER_FIELD.match(lines[index]) or not lines[index].strip()):
+        index += 1
+    return index
+
+
+def _normalize(text: str) -> str:
+    text = re.sub(r"^\s*>+ ?", "", text, flags=re.MULTILINE)
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def strip_quoted_text(text: str) -> Tuple[str, str]:
+    """Split a body into (novel text, quoted history).
+
+    Everything after a reply header ("On ... wrote:", "Original Message",
+    Outlook From:/Sent: blocks) is quoted, as are '>' lines. Forwarded-message
+    headers are dropped but the forwarded body is kept, since it is new content.
+    """
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    kept, quoted = [], []
+
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        if any(p.match(line) for p in FORWARD_HEADER_PATTERNS):
+            index = _skip_header_block(lines, index + 1)
+            continue
+        if _is_reply_header(lines, index):
+            quoted.extend(lines[index:])
+            break
+        if line.lstrip().startswith(">"):
+            quoted.append(line)
+        else:
+            kept.append(line)
+        index += 1
+
+    return "\n".join(kept).strip(), "\n".join(quoted).strip()
+
+
+def strip_signature(text: str, earlier_bodies: Iterable[str] = ()) -> Tuple[str, str]:
+    """Remove a '-- ' delimited signature, or a trailing block repeated from earlier messages."""
+    lines = text.split("\n")
+
+    for index in range(len(lines) - 1, -1, -1):
+        if SIGNATURE_DELIMITER.match(lines[index]):
+            return "\n".join(lines[:index]).rstrip(), "\n".join(lines[index:]).strip()
+
+    trailing = [l.strip() for l in lines]
+    best = 0
+    for earlier in earlier_bodies:
+        earlier_lines = [l.strip() for l in earlier.strip().split("\n")]
+        common = 0
+        while (
+            common < min(len(trailing) - 1, len(earlier_lines), MAX_SIGNATURE_LINES)
+            and trailing[-1 - common] == earlier_lines[-1 - common]
+        ):
+            common += 1
+        best = max(best, common)
+
+    signature_lines = [l for l in lines[len(lines) - best:] if l.strip()] if best else []
+    if len(signature_lines) < MIN_SIGNATURE_LINES:
+        return text, ""
+    return "\n".join(lines[:len(lines) - best]).rstrip(), "\n".join(lines[len(lines) - best:]).strip()
+
+
+def clean_email_body(text: str, earlier_bodies: Iterable[str] = ()) -> CleanedEmail:
+    """Strip quoted history, forwarded headers and repeated signatures from a pasted email"""
+    body, quoted = strip_quoted_text(text)
+    body, signature = strip_signature(body, earlier_bodies)
+    if not body:
+        # Nothing novel detected (e.g. a bare forward); fall back to the original
+        return CleanedEmail(text.strip(), "", "")
+    return CleanedEmail(body, quoted, signature)
+
+
+def find_quoted_message(quoted: str, earlier: Iterable[Tuple[int, str]]) -> Optional[int]:
+    """Return the id of the most recent earlier message whose text the quote repeats"""
+    normalized_quote = _normalize(quoted)
+    if not normalized_quote:
+        return None
+
+    match = None
+    for message_id, body in earlier:
+        normalized_body = _normalize(body)
+        if len(normalized_body) >= 20 and normalized_body in normalized_quote:
+            match = message_id
+    return match
+
+
+def normalize_incoming(content: str, earlier: List[Tuple[int, str, Optional[str]]]) -> Tuple[Optional[str], Optional[int]]:
+    """Ingestion stage shared by both apps.
+
+    ``earlier`` holds (id, original body, clean body or None) for prior messages
+    in sequence order. Returns (clean body or None when nothing was stripped,
+    id of the message the quoted text duplicates).
+    """
+    # Signatures are compared against earlier bodies minus their own quoted history
+    earlier_unquoted = [strip_quoted_text(raw)[0] for _, raw, _ in earlier]
+    cleaned = clean_email_body(content, earlier_unquoted)
+    quoted_message_id = find_quoted_message(
+        cleaned.quoted, [(mid, clean or raw) for mid, raw, clean in earlier]
+    )
+    clean_content = cleaned.body if cleaned.body != content.strip() else None
+    return clean_content, quoted_message_id
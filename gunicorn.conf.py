@@ -0,0 +1,35 @@
+import os
+
+# ----------------------------
+# Production entry point for the Flask API (app.py)
+# ----------------------------
+# gevent workers park each request on a greenlet, so a request waiting on
+# Gemini costs a few KB instead of a whole thread. Add workers for CPU, not
+# for waiting.
+#
+# Only network I/O yields to other greenlets. sqlite3 calls (including waits
+# on SQLite's 30 s busy timeout), zlib work and the background compression
+# backfill and archive sweep run on the worker's one OS thread and stall every
+# request of that worker while they run. Keep admission limits modest, and
+# scale with workers or tenant shards rather than by raising them.
+#   gunicorn -c gunicorn.conf.py app:app
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+worker_class = "gevent"
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", 1000))
+
+# LLM calls can take tens of seconds; don't let the arbiter kill busy workers
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
+
+# Admission limits: above the thread defaults, since waiting on Gemini is
+# cheap, but bounded by the database work above (override as usual)
+os.environ.setdefault("GENERATION_MAX_CONCURRENCY", "32")
+os.environ.setdefault("GENERATION_MAX_QUEUE", "64")
+os.environ.setdefault("SUMMARY_MAX_CONCURRENCY", "32")
+os.environ.setdefault("SUMMARY_MAX_QUEUE", "64")
@@ -0,0 +1,224 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+import repository
+from repository import Repository
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Group-commit ingestion
+# ----------------------------
+# Concurrent add_message calls are queued and written by one writer thread per
+# database file: everything that arrives within INGEST_COMMIT_WINDOW_MS of the
+# first pending message is inserted (with its updated_at bumps) in a single
+# transaction, so N messages cost one commit instead of N. Callers block on a
+# Future until their batch has committed and get their id and sequence back.
+# A caller that gives up after INGEST_CALLER_TIMEOUT has not cancelled its
+# message: it may still commit later, so a blind retry can duplicate it.
+#
+# INGEST_DURABILITY sets PRAGMA synchronous on the writer connection, i.e. what
+# an acknowledged message survives:
+#   full   - fsync on every group commit; survives power loss / OS crash
+#   normal - (default) WAL without per-commit fsync; survives an app crash, a
+#            power loss can drop the last acknowledged batches
+#   off    - no fsync at all; fastest, a power loss can corrupt the database
+
+COMMIT_WINDOW = float(os.getenv("INGEST_COMMIT_WINDOW_MS", 5)) / 1000
+MAX_BATCH = int(os.getenv("INGEST_MAX_BATCH", 500))
+MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", 10000))
+DURABILITY = os.getenv("INGEST_DURABILITY", "normal").lower()
+IDLE_TIMEOUT = float(os.getenv("INGEST_IDLE_TIMEOUT", 30))  # writer thread + connection close when idle
+CALLER_TIMEOUT = float(os.getenv("INGEST_CALLER_TIMEOUT", 30))
+
+SYNCHRONOUS = {"full": "FULL", "normal": "NORMAL", "off": "OFF"}
+
+
+class GroupCommitWriter:
+    """Batches message inserts for one SQLite file into group commits"""
+
+    def __init__(self, db_path: str, window: float = COMMIT_WINDOW, max_batch: int = MAX_BATCH,
+                 max_pending: int = MAX_PENDING, durability: str = DURABILITY,
+                 idle_timeout: float = IDLE_TIMEOUT):
+        if durability not in SYNCHRONOUS:
+            raise ValueError(f"INGEST_DURABILITY must be one of {', '.join(SYNCHRONOUS)}")
+        self.db_path = db_path
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.durability = durability
+        self.idle_timeout = idle_timeout
+        self.batches = 0
+        self.messages = 0
+        self.failures = 0
+        self.last_commit_ms: Optional[float] = None
+        self._queue: "queue.Queue[tuple]" = queue.Queue(maxsize=max_pending)
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, conversation_id: int, content: str, direction: str, normalize: bool = True,
+               message_id: Optional[str] = None, created_at: Optional[str] = None) -> Future:
+        """Queue one message; the Future resolves to the stored message dict once its batch commits"""
+        future: Future = Future()
+        item = {
+            "conversation_id": conversation_id,
+            "content": content,
+            "direction": direction,
+            "normalize": normalize,
+            "message_id": message_id,
+            "created_at": created_at,
+        }
+        # Blocks when MAX_PENDING messages are waiting: backpressure instead of unbounded memory
+        self._queue.put((item, future))
+        self._ensure_worker()
+        return future
+
+    def add_message(self, conversation_id: int, content: str, direction: str, normalize: bool = True,
+                    timeout: float = CALLER_TIMEOUT) -> Dict[str, Any]:
+        """Queue one message and wait for its commit.
+
+        A TimeoutError does not withdraw the message: it stays queued and may
+        still commit afterwards, so retrying after a timeout can store it twice.
+        """
+        return self.submit(conversation_id, content, direction, normalize).result(timeout)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "durability": self.durability,
+            "pending": self._queue.qsize(),
+            "batches": self.batches,
+            "messages": self.messages,
+            "failures": self.failures,
+            "avg_batch_size": round(self.messages / self.batches, 1) if self.batches else None,
+            "last_commit_ms": self.last_commit_ms,
+        }
+
+    def _ensure_worker(self) -> None:
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="ingest-writer", daemon=True)
+                self._worker.start()
+
+    def _run(self) -> None:
+        conn = None
+        try:
+            conn = repository.connect(self.db_path)
+            conn.execute(f"PRAGMA synchronous={SYNCHRONOUS[self.durability]}")
+            repo = Repository(conn)
+            while True:
+                try:
+                    first = self._queue.get(timeout=self.idle_timeout)
+                except queue.Empty:
+                    with self._start_lock:
+                        # Re-checked under the lock submit() takes after queueing, so no item is stranded
+                        if self._queue.empty():
+                            self._worker = None
+                            return
+                    continue
+                self._write(repo, self._collect(first))
+        except Exception as e:
+            logger.error(f"Ingest writer for {self.db_path} stopped: {str(e)}")
+            with self._start_lock:
+                # The next submit() starts a fresh writer; everything queued so far fails now
+                # instead of leaving its callers to time out
+                self._worker = None
+                self._fail_pending(e)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _fail_pending(self, error: Exception) -> None:
+        while True:
+            try:
+                _, future = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self.failures += 1
+            future.set_exception(error)
+
+    def _collect(self, first: tuple) -> List[tuple]:
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Whatever else is already queued rides along without extending the window
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, repo: Repository, batch: List[tuple]) -> None:
+        started = time.perf_counter()
+        try:
+            stored = repo.add_messages([item for item, _ in batch])
+        except Exception as e:
+            repo.conn.rollback()
+            if len(batch) == 1:
+                self.failures += 1
+                batch[0][1].set_exception(e)
+                return
+            logger.warning(f"Group commit of {len(batch)} messages failed, retrying one by one: {str(e)}")
+            self._write_individually(repo, batch)
+            return
+
+        self.batches += 1
+        self.messages += len(batch)
+        self.last_commit_ms = round((time.perf_counter() - started) * 1000, 2)
+        for (_, future), message in zip(batch, stored):
+            future.set_result(message)
+
+    def _write_individually(self, repo: Repository, batch: List[tuple]) -> None:
+        # Isolates the bad message (e.g. a deleted conversation) instead of failing its whole batch
+        for item, future in batch:
+            try:
+                future.set_result(repo.add_messages([item])[0])
+                self.batches += 1
+                self.messages += 1
+            except Exception as e:
+                repo.conn.rollback()
+                self.failures += 1
+                future.set_exception(e)
+
+
+_writers: Dict[str, GroupCommitWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(db_path: str) -> GroupCommitWriter:
+    """The process-wide writer for one database file (one per tenant shard)"""
+    db_path = os.path.abspath(db_path)
+    with _writers_lock:
+        writer = _writers.get(db_path)
+        if writer is None:
+            writer = _writers[db_path] = GroupCommitWriter(db_path)
+        return writer
+
+
+def writer_stats() -> Dict[str, Dict[str, Any]]:
+    with _writers_lock:
+        return {path: writer.snapshot() for path, writer in _writers.items()}
+
+
+def _drain_at_exit() -> None:
+    # Daemon writers die with the process; give queued messages one window to commit
+    deadline = time.monotonic() + max(COMMIT_WINDOW * 4, 1.0)
+    with _writers_lock:
+        writers = list(_writers.values())
+    while time.monotonic() < deadline and any(w._queue.qsize() for w in writers):
+        time.sleep(COMMIT_WINDOW or 0.01)
+
+
+atexit.register(_drain_at_exit)
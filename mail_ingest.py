@@ -0,0 +1,525 @@
+import os
+import re
+import html
+import time
+import hashlib
+import socket
+import asyncio
+import logging
+import argparse
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from email import message_from_bytes, policy
+from email.utils import getaddresses, parseaddr, parsedate_to_datetime
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import repository
+from repository import Repository
+from ingest_queue import get_writer, CALLER_TIMEOUT
+from sharding import SHARD_DIR, shard_file
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Mail ingestion daemon
+# ----------------------------
+# Streams received (and, for MAIL_INGEST_OWN_ADDRESSES, sent) mail into
+# conversations from a local SMTP listener, maildir folders and mbox files.
+# Mail is matched to a contact by address and to a conversation by its
+# In-Reply-To/References headers (falling back to the subject), then written
+# through the group-commit writer in ingest_queue.py.
+
+OWN_ADDRESSES = {a.strip().lower() for a in os.getenv("MAIL_INGEST_OWN_ADDRESSES", "").split(",") if a.strip()}
+CREATE_CONTACTS = os.getenv("MAIL_INGEST_CREATE_CONTACTS", "0") == "1"  # else mail from unknown addresses is skipped
+POLL_INTERVAL = float(os.getenv("MAIL_INGEST_POLL_INTERVAL", 5))
+MAX_MESSAGE_BYTES = int(os.getenv("MAIL_INGEST_MAX_BYTES", 10 * 1024 * 1024))
+MBOX_SETTLE_SECONDS = float(os.getenv("MAIL_INGEST_MBOX_SETTLE", 2))  # last message is read once the file is quiet
+MAILDIR_BATCH = int(os.getenv("MAIL_INGEST_MAILDIR_BATCH", 500))
+MAX_ATTEMPTS = int(os.getenv("MAIL_INGEST_MAX_ATTEMPTS", 5))  # failures before a message is dead-lettered
+DEAD_LETTER_DIR = os.getenv("MAIL_INGEST_DEAD_LETTER_DIR")  # default: mail-dead-letter/ next to the database
+SMTP_HOSTNAME = os.getenv("MAIL_INGEST_HOSTNAME") or socket.getfqdn()
+
+MAX_THREAD_IDS = 50  # newest In-Reply-To/References entries consulted per message
+RECENT_MESSAGE_IDS = 5000  # Message-IDs still in the writer queue, for replies in the same batch
+
+SUBJECT_PREFIX = re.compile(r"^\s*((re|fwd?|aw|sv)(\[\d+\])?\s*:\s*)+", re.IGNORECASE)
+MESSAGE_ID = re.compile(r"<[^<>\s]+>")
+MBOX_SEPARATOR = re.compile(rb"^From ", re.MULTILINE)
+MBOX_ESCAPED_FROM = re.compile(rb"^>(>*From )", re.MULTILINE)
+
+# Outcome of one message: committed, deliberately dropped (duplicate, unknown
+# sender, dead-lettered after MAX_ATTEMPTS failures, ...) or failed and worth retrying
+STORED, SKIPPED, FAILED = "stored", "skipped", "failed"
+
+
+class ParsedMail(NamedTuple):
+    message_id: str  # Message-ID header, or a content hash for mail without one (see content_message_id)
+    thread_ids: List[str]  # In-Reply-To then References, newest first
+    subject: str  # without Re:/Fwd: prefixes
+    sender: str
+    sender_name: str
+    recipients: List[Tuple[str, str]]  # (display name, address) from To and Cc
+    body: str
+    created_at: Optional[str]
+
+
+class IngestResult(NamedTuple):
+    status: str  # STORED, SKIPPED or FAILED
+    message: Optional[Dict[str, Any]] = None  # the stored message when STORED
+
+
+def html_to_text(markup: str) -> str:
+    markup = re.sub(r"(?is)<(script|style)\b.*?</\1>", "", markup)
+    markup = re.sub(r"(?i)<br\s*/?>|</(p|div|li|tr|h\d)>", "\n", markup)
+    text = html.unescape(re.sub(r"<[^>]+>", "", markup))
+    return re.sub(r"\n\s*\n+", "\n\n", text).strip()
+
+
+def content_message_id(raw: bytes) -> str:
+    """Stand-in Message-ID for mail without one, so re-reads of it are still recognised as duplicates"""
+    return f"<{hashlib.sha256(raw).hexdigest()[:32]}@content-hash.invalid>"
+
+
+def parse_mail(raw: bytes) -> ParsedMail:
+    msg = message_from_bytes(raw, policy=policy.default)
+
+    message_id = MESSAGE_ID.search(str(msg.get("Message-ID", "")))
+    thread_ids = MESSAGE_ID.findall(str(msg.get("In-Reply-To", "")))
+    thread_ids += reversed(MESSAGE_ID.findall(str(msg.get("References", ""))))
+
+    part = msg.get_body(preferencelist=("plain", "html"))
+    body = ""
+    if part is not None:
+        try:
+            body = part.get_content()
+        except (LookupError, UnicodeError):
+            body = (part.get_payload(decode=True) or b"").decode("utf-8", "replace")
+        if part.get_content_type() == "text/html":
+            body = html_to_text(body)
+
+    created_at = None
+    try:
+        sent = parsedate_to_datetime(str(msg.get("Date", "")))
+        if sent.tzinfo is not None:
+            sent = sent.astimezone(timezone.utc).replace(tzinfo=None)
+        created_at = sent.isoformat(sep=" ")
+    except (TypeError, ValueError):
+        pass
+
+    sender_name, sender = parseaddr(str(msg.get("From", "")))
+    return ParsedMail(
+        message_id=message_id.group(0) if message_id else content_message_id(raw),
+        thread_ids=list(dict.fromkeys(thread_ids))[:MAX_THREAD_IDS],
+        subject=SUBJECT_PREFIX.sub("", str(msg.get("Subject", ""))).strip(),
+        sender=sender.lower(),
+        sender_name=sender_name,
+        recipients=[(name, address.lower()) for name, address in
+                    getaddresses([str(v) for v in msg.get_all("To", []) + msg.get_all("Cc", [])]) if address],
+        body=body.replace("\r\n", "\n").strip(),
+        created_at=created_at,
+    )
+
+
+class MailIngestor:
+    """Matches parsed mail to contacts/conversations and queues it for group commit.
+
+    Matching runs under one lock (it may create conversations); waiting for the
+    commit does not, so concurrent SMTP sessions share group commits.
+    Message-IDs still in the writer queue live in ``_queued_ids`` under their
+    own lock, which the writer thread also takes to forget failed messages.
+    Failed attempts are counted per message content (in memory, so a restart
+    starts over); after ``max_attempts`` the message is saved to
+    ``dead_letter_dir`` and reported SKIPPED, so no source retries it forever.
+    """
+
+    def __init__(self, db_path: str, own_addresses: Iterable[str] = OWN_ADDRESSES,
+                 create_contacts: bool = CREATE_CONTACTS, max_attempts: int = MAX_ATTEMPTS,
+                 dead_letter_dir: Optional[str] = DEAD_LETTER_DIR):
+        self.repo = Repository(repository.connect(db_path))
+        self.writer = get_writer(db_path)
+        self.own_addresses = {address.lower() for address in own_addresses}
+        self.create_contacts = create_contacts
+        self.max_attempts = max_attempts
+        self.dead_letter_dir = dead_letter_dir or os.path.join(os.path.dirname(os.path.abspath(db_path)),
+                                                               "mail-dead-letter")
+        self.stats: Counter = Counter()
+        self._queued_ids: "OrderedDict[str, int]" = OrderedDict()
+        self._queued_lock = threading.Lock()
+        self._failures: Counter = Counter()
+        self._failures_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def ingest(self, raw_messages: Iterable[bytes]) -> List[IngestResult]:
+        """Store each raw message; one IngestResult per message, in order.
+
+        FAILED means the message was not committed (or not within
+        CALLER_TIMEOUT) and the source must offer it again; SKIPPED ones are
+        deliberately dropped (or dead-lettered) and must not be retried.
+        """
+        raw_messages = list(raw_messages)
+        with self._lock:
+            futures = []
+            for raw in raw_messages:
+                try:
+                    futures.append(self._submit(raw))
+                except Exception as e:
+                    # e.g. the database is locked while matching; the next attempt may succeed
+                    logger.error(f"Failed to match ingested mail: {str(e)}")
+                    futures.append(e)
+
+        results = []
+        for raw, future in zip(raw_messages, futures):
+            if future is None:
+                results.append(IngestResult(SKIPPED))
+                continue
+            try:
+                if isinstance(future, Exception):
+                    raise future
+                results.append(IngestResult(STORED, future.result(CALLER_TIMEOUT)))
+                self.stats["stored"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"Failed to store ingested mail: {str(e) or type(e).__name__}")
+                results.append(self._failed(raw))
+        return results
+
+    def get_position(self, source: str) -> int:
+        with self._lock:
+            return self.repo.get_ingest_position(source)
+
+    def save_position(self, source: str, position: int) -> None:
+        # Shares the matching connection, so it takes the same lock
+        with self._lock:
+            self.repo.save_ingest_position(source, position)
+
+    def _failed(self, raw: bytes) -> IngestResult:
+        """FAILED, or SKIPPED once the message has failed max_attempts times and was dead-lettered"""
+        key = hashlib.sha256(raw).hexdigest()
+        with self._failures_lock:
+            self._failures[key] += 1
+            if self._failures[key] < self.max_attempts:
+                return IngestResult(FAILED)
+            del self._failures[key]
+
+        os.makedirs(self.dead_letter_dir, exist_ok=True)
+        path = os.path.join(self.dead_letter_dir, f"{datetime.utcnow():%Y%m%dT%H%M%S}-{key[:16]}.eml")
+        with open(path, "wb") as f:
+            f.write(raw)
+        self.stats["dead_lettered"] += 1
+        logger.error(f"Giving up on mail after {self.max_attempts} failed attempts; saved to {path}")
+        return IngestResult(SKIPPED)
+
+    def _submit(self, raw: bytes):
+        try:
+            mail = parse_mail(raw)
+        except Exception as e:
+            self.stats["unparseable"] += 1
+            logger.warning(f"Skipping unparseable mail: {str(e)}")
+            return None
+
+        if not mail.body:
+            self.stats["empty"] += 1
+            return None
+        if (self._queued_conversation([mail.message_id]) is not None
+                or self.repo.find_conversation_by_message_ids([mail.message_id])):
+            self.stats["duplicate"] += 1
+            return None
+
+        match = self._match(mail)
+        if match is None:
+            self.stats["unmatched"] += 1
+            logger.info(f"No contact for mail from {mail.sender or 'unknown sender'}; skipped")
+            return None
+        conversation_id, direction = match
+
+        future = self.writer.submit(conversation_id, mail.body, direction,
+                                    message_id=mail.message_id, created_at=mail.created_at)
+        with self._queued_lock:
+            self._queued_ids[mail.message_id] = conversation_id
+            while len(self._queued_ids) > RECENT_MESSAGE_IDS:
+                self._queued_ids.popitem(last=False)
+        # A failed write must not make its retry look like a duplicate (even after a caller timeout)
+        future.add_done_callback(lambda done: done.exception() and self._forget(mail.message_id))
+        return future
+
+    def _queued_conversation(self, message_ids: List[str]) -> Optional[int]:
+        with self._queued_lock:
+            return next((self._queued_ids[m] for m in message_ids if m in self._queued_ids), None)
+
+    def _forget(self, message_id: str) -> None:
+        with self._queued_lock:
+            self._queued_ids.pop(message_id, None)
+
+    def _match(self, mail: ParsedMail) -> Optional[Tuple[int, str]]:
+        if mail.sender in self.own_addresses:
+            direction, counterparts = "sent", mail.recipients
+        else:
+            direction, counterparts = "received", [(mail.sender_name, mail.sender)]
+
+        # Thread headers win over the subject: a reply stays in its thread even if retitled
+        conversation_id = self._queued_conversation(mail.thread_ids)
+        if conversation_id is None:
+            conversation_id = self.repo.find_conversation_by_message_ids(mail.thread_ids)
+
+        if conversation_id is None:
+            contacts = self.repo.find_contacts_by_email([address for _, address in counterparts])
+            contact_id = next((contacts[address] for _, address in counterparts if address in contacts), None)
+            if contact_id is None:
+                if not self.create_contacts or not counterparts:
+                    return None
+                name, address = counterparts[0]
+                contact_id = self.repo.add_contact(name or address.split("@")[0], address)
+                self.stats["contacts_created"] += 1
+
+            title = mail.subject or "(no subject)"
+            conversation_id = self.repo.find_conversation_by_title(contact_id, title)
+            if conversation_id is None:
+                conversation_id = self.repo.add_conversation(contact_id, title)
+                self.stats["conversations_created"] += 1
+
+        # New mail brings an archived thread back to the hot tier, as in app.py
+        if self.repo.is_archived(conversation_id):
+            self.repo.unarchive_conversation(conversation_id)
+        return conversation_id, direction
+
+
+# ----------------------------
+# Drop sources (polled)
+# ----------------------------
+class MaildirSource:
+    """Ingests files from <maildir>/new and moves them to cur/ with the Seen flag.
+
+    Files whose message failed to store stay in new/ and are retried on the next
+    poll, until the ingestor dead-letters them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        for sub in ("new", "cur", "tmp"):
+            os.makedirs(os.path.join(path, sub), exist_ok=True)
+
+    def poll(self, ingestor: MailIngestor) -> int:
+        new_dir = os.path.join(self.path, "new")
+        names = sorted(os.listdir(new_dir))[:MAILDIR_BATCH]
+        raws = []
+        for name in names:
+            with open(os.path.join(new_dir, name), "rb") as f:
+                raws.append(f.read())
+        results = ingestor.ingest(raws)
+        for name, result in zip(names, results):
+            if result.status == FAILED:
+                continue
+            # Moved even when skipped, so a poll never re-reads the same file
+            os.rename(os.path.join(new_dir, name), os.path.join(self.path, "cur", name.split(":")[0] + ":2,S"))
+        return len(names)
+
+
+class MboxSource:
+    """Reads an mbox incrementally from the last committed offset (kept in mail_ingest_state).
+
+    The offset never moves past a message that failed to store (until the
+    ingestor dead-letters it); messages after it that did store are re-read with
+    it and skipped by Message-ID, or by content hash when they have none.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.key = f"mbox:{os.path.abspath(path)}"
+
+    def poll(self, ingestor: MailIngestor) -> int:
+        if not os.path.exists(self.path):
+            return 0
+        position = ingestor.get_position(self.key)
+        stat = os.stat(self.path)
+        if stat.st_size < position:
+            position = 0  # truncated or rotated; Message-ID dedup skips what we already have
+        if stat.st_size == position:
+            return 0
+
+        with open(self.path, "rb") as f:
+            f.seek(position)
+            data = f.read()
+        settled = time.time() - stat.st_mtime >= MBOX_SETTLE_SECONDS
+        messages, starts, consumed = split_mbox(data, final=settled)
+        results = ingestor.ingest(messages)
+        failed = next((index for index, result in enumerate(results) if result.status == FAILED), None)
+        if failed is not None:
+            consumed = starts[failed]
+        if consumed:
+            ingestor.save_position(self.key, position + consumed)
+        return len(messages)
+
+
+def split_mbox(data: bytes, final: bool) -> Tuple[List[bytes], List[int], int]:
+    """Complete messages in an mbox chunk, the offset each one starts at, and the bytes consumed.
+
+    The last message may still be being appended, so it is only taken when
+    ``final`` (the file has been quiet for MBOX_SETTLE_SECONDS).
+    """
+    starts = [m.start() for m in MBOX_SEPARATOR.finditer(data)]
+    if not starts:
+        return [], [], len(data) if final else 0
+    ends = starts[1:] + ([len(data)] if final else [])
+    messages = []
+    for start, end in zip(starts, ends):
+        chunk = data[start:end]
+        chunk = chunk[chunk.find(b"\n") + 1:] if b"\n" in chunk else b""  # drop the "From " line
+        messages.append(MBOX_ESCAPED_FROM.sub(rb"\1", chunk))
+    return messages, starts[:len(messages)], (len(data) if final else starts[-1])
+
+
+# ----------------------------
+# Local SMTP listener
+# ----------------------------
+class SMTPListener:
+    """Minimal SMTP receiver (HELO/EHLO, MAIL, RCPT, DATA, RSET, NOOP, QUIT) for local delivery.
+
+    Replies 250 to DATA only after the message is committed (or deliberately
+    skipped or dead-lettered), and 451 if storing failed or timed out so the
+    sending MTA retries.
+    """
+
+    def __init__(self, ingestor: MailIngestor, host: str = "127.0.0.1", port: int = 8025,
+                 hostname: str = SMTP_HOSTNAME, max_bytes: int = MAX_MESSAGE_BYTES):
+        self.ingestor = ingestor
+        self.host = host
+        self.port = port
+        self.hostname = hostname
+        self.max_bytes = max_bytes
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._session, self.host, self.port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def _session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        async def reply(*lines: str) -> None:
+            writer.write("".join(line + "\r\n" for line in lines).encode("utf-8"))
+            await writer.drain()
+
+        mail_from, recipients = None, []
+        try:
+            await reply(f"220 {self.hostname} ESMTP ready")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command, _, argument = line.decode("utf-8", "replace").strip().partition(" ")
+                command = command.upper()
+
+                if command == "EHLO":
+                    await reply(f"250-{self.hostname}", f"250-SIZE {self.max_bytes}", "250-8BITMIME", "250 SMTPUTF8")
+                elif command == "HELO":
+                    await reply(f"250 {self.hostname}")
+                elif command == "MAIL":
+                    if not argument.upper().startswith("FROM:"):
+                        await reply("501 Syntax: MAIL FROM:<address>")
+                        continue
+                    mail_from, recipients = argument[5:].strip(), []
+                    await reply("250 OK")
+                elif command == "RCPT":
+                    if mail_from is None:
+                        await reply("503 Need MAIL command")
+                    elif not argument.upper().startswith("TO:"):
+                        await reply("501 Syntax: RCPT TO:<address>")
+                    else:
+                        recipients.append(argument[3:].strip())
+                        await reply("250 OK")
+                elif command == "DATA":
+                    if not recipients:
+                        await reply("503 Need RCPT command")
+                        continue
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    data = await self._read_data(reader)
+                    mail_from, recipients = None, []
+                    if data is None:
+                        await reply("552 Message exceeds fixed maximum message size")
+                        continue
+                    try:
+                        loop = asyncio.get_running_loop()
+                        [result] = await loop.run_in_executor(None, self.ingestor.ingest, [data])
+                    except Exception as e:
+                        logger.error(f"SMTP delivery failed: {str(e)}")
+                        result = IngestResult(FAILED)
+                    if result.status == FAILED:
+                        await reply("451 Requested action aborted: local error")
+                        continue
+                    await reply("250 OK")
+                elif command == "RSET":
+                    mail_from, recipients = None, []
+                    await reply("250 OK")
+                elif command == "NOOP":
+                    await reply("250 OK")
+                elif command == "QUIT":
+                    await reply("221 Bye")
+                    break
+                else:
+                    await reply("502 Command not implemented")
+        except (ConnectionError, ValueError, asyncio.LimitOverrunError) as e:
+            logger.info(f"SMTP session ended: {str(e)}")
+        finally:
+            writer.close()
+
+    async def _read_data(self, reader: asyncio.StreamReader) -> Optional[bytes]:
+        """Read DATA up to the lone '.' line; None (after draining) when over max_bytes"""
+        lines, size = [], 0
+        while True:
+            line = await reader.readline()
+            if not line or line in (b".\r\n", b".\n"):
+                break
+            if line.startswith(b".."):
+                line = line[1:]
+            size += len(line)
+            if size <= self.max_bytes:
+                lines.append(line)
+        return b"".join(lines) if size <= self.max_bytes else None
+
+
+# ----------------------------
+# Daemon
+# ----------------------------
+def run_daemon(db_path: str, smtp: Optional[Tuple[str, int]], maildirs: List[str], mboxes: List[str]) -> None:
+    ingestor = MailIngestor(db_path)
+    sources = [MaildirSource(path) for path in maildirs] + [MboxSource(path) for path in mboxes]
+
+    async def main() -> None:
+        if smtp:
+            port = await SMTPListener(ingestor, *smtp).start()
+            logger.info(f"Listening for SMTP on {smtp[0]}:{port}")
+        loop = asyncio.get_running_loop()
+        while True:
+            for source in sources:
+                try:
+                    await loop.run_in_executor(None, source.poll, ingestor)
+                except Exception as e:
+                    logger.error(f"Polling {source.path} failed: {str(e)}")
+            await asyncio.sleep(POLL_INTERVAL)
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Stream mail from SMTP, maildir and mbox drops into conversations")
+    parser.add_argument("--db", default=os.getenv("MAIL_INGEST_DB"), help="SQLite database to write to")
+    parser.add_argument("--tenant", help="write to this tenant's shard in TENANT_SHARD_DIR instead of --db")
+    parser.add_argument("--smtp", metavar="HOST:PORT", help="accept mail over SMTP, e.g. 127.0.0.1:8025")
+    parser.add_argument("--maildir", action="append", default=[], help="maildir to watch (repeatable)")
+    parser.add_argument("--mbox", action="append", default=[], help="mbox file to follow (repeatable)")
+    args = parser.parse_args()
+
+    if args.tenant:
+        if not SHARD_DIR:
+            parser.error("--tenant requires TENANT_SHARD_DIR")
+        args.db = shard_file(SHARD_DIR, args.tenant)
+    if not args.db:
+        parser.error("--db (or MAIL_INGEST_DB) is required")
+    if not (args.smtp or args.maildir or args.mbox):
+        parser.error("nothing to ingest: pass --smtp, --maildir and/or --mbox")
+
+    smtp_address = None
+    if args.smtp:
+        host, _, port = args.smtp.rpartition(":")
+        smtp_address = (host or "127.0.0.1", int(port))
+    run_daemon(args.db, smtp_address, args.maildir, args.mbox)
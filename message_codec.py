@@ -0,0 +1,271 @@
+import os
+import sys
+import time
+import socket
+import zlib
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Any, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Transparent compression of large message bodies
+# ----------------------------
+# Bodies at or above the threshold are stored zlib-compressed in a BLOB column
+# (``content_z``) and the TEXT column is left empty. An optional preset
+# dictionary (see ``build_dictionary``) primes zlib with the signatures,
+# disclaimers and greetings that repeat across pasted threads.
+COMPRESSION_THRESHOLD = int(os.getenv("MESSAGE_COMPRESSION_THRESHOLD", 1024))
+COMPRESSION_LEVEL = int(os.getenv("MESSAGE_COMPRESSION_LEVEL", 6))
+ZDICT_PATH = os.getenv("MESSAGE_ZDICT_PATH")
+
+_PLAIN_HEADER = b"Z1"
+_DICT_HEADER = b"D1"
+
+
+def _load_zdict() -> Tuple[Optional[bytes], bytes]:
+    if not ZDICT_PATH or not os.path.exists(ZDICT_PATH):
+        return None, b""
+    with open(ZDICT_PATH, "rb") as f:
+        zdict = f.read()
+    return zdict, zlib.crc32(zdict).to_bytes(4, "big")
+
+
+_ZDICT, _ZDICT_ID = _load_zdict()
+
+
+class DecodeStats:
+    """Process-wide counters for the cost of reading compressed bodies."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.compressed_reads = 0
+        self.decode_seconds = 0.0
+
+    def record(self, compressed: bool, seconds: float) -> None:
+        with self._lock:
+            self.reads += 1
+            if compressed:
+                self.compressed_reads += 1
+                self.decode_seconds += seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            avg = self.decode_seconds / self.compressed_reads if self.compressed_reads else 0.0
+            return {
+                "reads": self.reads,
+                "compressed_reads": self.compressed_reads,
+                "decode_seconds_total": round(self.decode_seconds, 6),
+                "decode_us_per_compressed_read": round(avg * 1_000_000, 2),
+            }
+
+
+decode_stats = DecodeStats()
+
+
+def compress_text(text: str) -> bytes:
+    raw = text.encode("utf-8")
+    if _ZDICT:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=_ZDICT)
+        return _DICT_HEADER + _ZDICT_ID + compressor.compress(raw) + compressor.flush()
+    return _PLAIN_HEADER + zlib.compress(raw, COMPRESSION_LEVEL)
+
+
+def decompress_text(blob: bytes) -> str:
+    blob = bytes(blob)
+    header = blob[:2]
+    if header == _PLAIN_HEADER:
+        return zlib.decompress(blob[2:]).decode("utf-8")
+    if header == _DICT_HEADER:
+        if blob[2:6] != _ZDICT_ID:
+            raise ValueError("Message was compressed with a different dictionary than MESSAGE_ZDICT_PATH")
+        decompressor = zlib.decompressobj(zdict=_ZDICT)
+        return (decompressor.decompress(blob[6:]) + decompressor.flush()).decode("utf-8")
+    raise ValueError(f"Unknown compressed message header: {header!r}")
+
+
+def encode_content(text: str) -> Tuple[str, Optional[bytes], int]:
+    """Split a body into (text column, blob column, raw size) for storage."""
+    raw_size = len(text.encode("utf-8"))
+    if raw_size < COMPRESSION_THRESHOLD:
+        return text, None, raw_size
+
+    blob = compress_text(text)
+    if len(blob) >= raw_size:
+        # Incompressible: keeping it as text is cheaper to read
+        return text, None, raw_size
+    return "", blob, raw_size
+
+
+def decode_content(text: Optional[str], blob: Optional[bytes]) -> str:
+    """Inverse of ``encode_content``; records per-read decode cost."""
+    if blob is None:
+        decode_stats.record(False, 0.0)
+        return text or ""
+
+    started = time.perf_counter()
+    decoded = decompress_text(blob)
+    decode_stats.record(True, time.perf_counter() - started)
+    return decoded
+
+
+def build_dictionary(samples: Iterable[str], max_size: int = 32 * 1024) -> bytes:
+    """Build a zlib preset dictionary from the lines that repeat most across samples.
+
+    zlib favours matches near the end of the dictionary, so the most common
+    lines are placed last.
+    """
+    counts = Counter()
+    for sample in samples:
+        for line in set(sample.splitlines()):
+            line = line.strip()
+            if len(line) >= 8:
+                counts[line] += 1
+
+    selected = []
+    size = 0
+    for line, count in counts.most_common():
+        if count < 2:
+            break
+        encoded = (line + "\n").encode("utf-8")
+        if size + len(encoded) > max_size:
+            break
+        selected.append(encoded)
+        size += len(encoded)
+
+    return b"".join(reversed(selected))
+
+# ----------------------------
+# Storage helpers shared by both apps (DB-API / sqlite3 connections)
+# ----------------------------
+# A claim that has not made progress for this long is taken over by the next process
+BACKFILL_LEASE_SECONDS = int(os.getenv("MESSAGE_COMPRESSION_BACKFILL_LEASE", 300))
+
+
+def _utcnow(offset: float = 0.0) -> str:
+    return (datetime.utcnow() + timedelta(seconds=offset)).isoformat(sep=" ")
+
+
+def claim_task(conn, task: str, lease: int = BACKFILL_LEASE_SECONDS) -> bool:
+    """Claim a one-off task in ``maintenance_tasks`` (repository.py migration 11).
+
+    False when the task already finished or another process holds a claim
+    renewed within ``lease`` seconds.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT claimed_at, finished_at FROM maintenance_tasks WHERE task = ?", (task,)
+        ).fetchone()
+        if row and (row[1] is not None or (row[0] is not None and row[0] > _utcnow(-lease))):
+            conn.rollback()
+            return False
+        conn.execute(
+            "INSERT INTO maintenance_tasks (task, owner, claimed_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(task) DO UPDATE SET owner = excluded.owner, claimed_at = excluded.claimed_at",
+            (task, f"{socket.gethostname()}:{os.getpid()}", _utcnow())
+        )
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def backfill_compression(conn, table: str, batch_size: int = 200, pause: float = 0.05) -> int:
+    """Compress existing rows above the threshold in small batches. Returns rows rewritten.
+
+    Runs once per database: every app process calls this at startup, but only
+    the one that claims the task does the work, renewing its claim each batch.
+    """
+    task = f"compress:{table}"
+    if not claim_task(conn, task):
+        return 0
+
+    rewritten = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            f"SELECT id, content FROM {table} "
+            f"WHERE id > ? AND content_z IS NULL AND length(CAST(content AS BLOB)) >= ? "
+            f"ORDER BY id LIMIT ?",
+            (last_id, COMPRESSION_THRESHOLD, batch_size),
+        ).fetchall()
+        if not rows:
+            break
+
+        updates = []
+        for row_id, content in rows:
+            last_id = row_id
+            text, blob, raw_size = encode_content(content)
+            if blob is not None:
+                updates.append((text, blob, raw_size, row_id))
+
+        if updates:
+            conn.executemany(
+                f"UPDATE {table} SET content = ?, content_z = ?, content_size = ? WHERE id = ?",
+                updates,
+            )
+            rewritten += len(updates)
+        conn.execute("UPDATE maintenance_tasks SET claimed_at = ? WHERE task = ?", (_utcnow(), task))
+        conn.commit()
+
+        # Yield the writer lock to foreground requests between batches
+        time.sleep(pause)
+
+    conn.execute("UPDATE maintenance_tasks SET finished_at = ? WHERE task = ?", (_utcnow(), task))
+    conn.commit()
+    if rewritten:
+        logger.info(f"Compressed {rewritten} existing rows in {table}")
+    return rewritten
+
+
+def storage_report(conn, table: str) -> Dict[str, Any]:
+    """Bytes saved by compression plus the decode cost observed by this process."""
+    total_rows, compressed_rows, raw_bytes, stored_bytes = conn.execute(
+        f"""
+        SELECT COUNT(*),
+               COALESCE(SUM(content_z IS NOT NULL), 0),
+               COALESCE(SUM(CASE WHEN content_z IS NOT NULL THEN content_size
+                                 ELSE length(CAST(content AS BLOB)) END), 0),
+               COALESCE(SUM(length(CAST(content AS BLOB)) + COALESCE(length(content_z), 0)), 0)
+        FROM {table}
+        """
+    ).fetchone()
+
+    return {
+        "rows": total_rows,
+        "compressed_rows": compressed_rows,
+        "raw_bytes": raw_bytes,
+        "stored_bytes": stored_bytes,
+        "bytes_saved": raw_bytes - stored_bytes,
+        "ratio": round(stored_bytes / raw_bytes, 3) if raw_bytes else 1.0,
+        "threshold": COMPRESSION_THRESHOLD,
+        "dictionary": bool(_ZDICT),
+        "decode": decode_stats.snapshot(),
+    }
+
+
+if __name__ == "__main__":
+    # Train a preset dictionary from an existing database:
+    #   python message_codec.py conversations.db messages message.zdict
+    import sqlite3
+
+    if len(sys.argv) != 4:
+        print("usage: python message_codec.py <sqlite-db> <messages-table> <output.zdict>")
+        sys.exit(1)
+
+    db_path, table_name, output_path = sys.argv[1:]
+    source = sqlite3.connect(db_path)
+    bodies = [
+        decode_content(content, blob)
+        for content, blob in source.execute(f"SELECT content, content_z FROM {table_name}")
+    ]
+    dictionary = build_dictionary(bodies)
+    with open(output_path, "wb") as out:
+        out.write(dictionary)
+    print(f"Wrote {len(dictionary)} byte dictionary from {len(bodies)} messages to {output_path}")
@@ -0,0 +1,337 @@
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import random
+import cProfile
+import logging
+import importlib
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from flask import g, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# On-demand request profiling
+# ----------------------------
+# A request is profiled when it carries X-Profile-Token matching PROFILE_TOKEN,
+# or when it falls in the PROFILE_SAMPLE_RATE fraction of traffic. Each profile
+# writes <id>.json (per-phase timings) plus either <id>.pstats (cProfile) or
+# <id>.collapsed (stack sampler, flamegraph.pl / speedscope ready).
+#
+# Under gevent every greenlet of a worker shares one OS thread. Both modes see
+# that whole thread, so a profile can include frames of other requests that ran
+# while the profiled one was waiting on I/O.
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_HEADER = "X-Profile-Token"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_MODE = os.getenv("PROFILE_MODE", "cprofile")  # 'cprofile' or 'sampler'
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 200))
+SAMPLER_INTERVAL = float(os.getenv("PROFILE_SAMPLER_INTERVAL", 0.005))
+
+# cProfile can only have one active profiler per process on Python 3.12+
+_cprofile_lock = threading.Lock()
+
+
+def _unpatched(module: str, name: str):
+    """``module.name`` as it was before gevent monkey-patching (the module's own attribute otherwise)"""
+    try:
+        from gevent.monkey import get_original
+    except ImportError:
+        return getattr(importlib.import_module(module), name)
+    return get_original(module, name)
+
+
+# The sampler needs real OS threads: patched ones are greenlets that share the
+# request's thread, and patched get_ident() returns greenlet ids
+_get_ident = _unpatched("_thread", "get_ident")
+_start_new_thread = _unpatched("_thread", "start_new_thread")
+_allocate_lock = _unpatched("_thread", "allocate_lock")
+_sleep = _unpatched("time", "sleep")
+
+
+def _profiling() -> bool:
+    return has_request_context() and getattr(g, "profile_phases", None) is not None
+
+
+@contextmanager
+def profile_phase(name: str):
+    """Attribute the enclosed time to a named phase of the current profiled request"""
+    phases = getattr(g, "profile_phases", None) if has_request_context() else None
+    if phases is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] += time.perf_counter() - started
+
+
+class _ProfiledCursor:
+    """Cursor proxy that times row fetches (sqlite3 steps the statement lazily) as 'db'"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def fetchone(self):
+        with profile_phase("db"):
+            return self._cursor.fetchone()
+
+    def fetchmany(self, *args, **kwargs):
+        with profile_phase("db"):
+            return self._cursor.fetchmany(*args, **kwargs)
+
+    def fetchall(self):
+        with profile_phase("db"):
+            return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class ProfiledConnection:
+    """DB-API connection proxy: times and counts statements issued outside the ORM (repository.py)"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def execute(self, sql, *args, **kwargs):
+        return self._statement(self._conn.execute, sql, *args, **kwargs)
+
+    def executemany(self, sql, *args, **kwargs):
+        return self._statement(self._conn.executemany, sql, *args, **kwargs)
+
+    def commit(self) -> None:
+        with profile_phase("db"):
+            self._conn.commit()
+
+    def rollback(self) -> None:
+        with profile_phase("db"):
+            self._conn.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    @staticmethod
+    def _statement(call, *args, **kwargs) -> _ProfiledCursor:
+        with profile_phase("db"):
+            cursor = call(*args, **kwargs)
+        if _profiling():
+            g.profile_queries += 1
+        return _ProfiledCursor(cursor)
+
+
+def profiled_connection(conn):
+    """Wrap a raw connection for the current request when it is being profiled"""
+    return ProfiledConnection(conn) if _profiling() else conn
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Default JSON provider that reports time spent serializing as the 'serialization' phase"""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        with profile_phase("serialization"):
+            return super().dumps(obj, **kwargs)
+
+
+class StackSampler:
+    """Low-overhead sampler: snapshots one OS thread's stack every interval into collapsed stacks.
+
+    ``thread_id`` is a real OS thread id and the sampler runs on its own OS
+    thread, so it also works under gevent. There the samples show whichever
+    greenlet held the thread, which may belong to another request.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._running = False
+        self._done = _allocate_lock()
+
+    def start(self) -> None:
+        self._running = True
+        self._done.acquire()
+        _start_new_thread(self._run, ())
+
+    def stop(self) -> None:
+        # Waits at most one interval for the last sample to finish
+        self._running = False
+        with self._done:
+            pass
+
+    def _run(self) -> None:
+        try:
+            while True:
+                _sleep(self.interval)
+                if not self._running:
+                    return
+                frame = sys._current_frames().get(self.thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+        finally:
+            self._done.release()
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class RequestProfiler:
+    def __init__(self, directory: str = PROFILE_DIR, keep: int = PROFILE_KEEP):
+        self.directory = directory
+        self.keep = keep
+
+    def init_app(self, app) -> None:
+        app.json = TimedJSONProvider(app)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def instrument_engine(self, engine) -> None:
+        """Time every SQL statement as the 'db' phase"""
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if _profiling():
+                conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            starts = conn.info.get("profile_query_start")
+            if starts and _profiling():
+                g.profile_phases["db"] += time.perf_counter() - starts.pop()
+                g.profile_queries += 1
+
+    def authorized(self) -> bool:
+        supplied = request.headers.get(PROFILE_HEADER)
+        return bool(PROFILE_TOKEN and supplied and hmac.compare_digest(supplied, PROFILE_TOKEN))
+
+    def _should_profile(self) -> bool:
+        if self.authorized():
+            return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    def _before_request(self) -> None:
+        if not self._should_profile():
+            return
+
+        mode = request.headers.get("X-Profile-Mode", PROFILE_MODE) if self.authorized() else PROFILE_MODE
+        if mode == "cprofile":
+            if not _cprofile_lock.acquire(blocking=False):
+                return  # another request is being profiled; skip rather than wait
+            g.profile_collector = cProfile.Profile()
+            g.profile_collector.enable()
+        else:
+            g.profile_collector = StackSampler(_get_ident(), SAMPLER_INTERVAL)
+            g.profile_collector.start()
+
+        g.profile_phases = defaultdict(float)
+        g.profile_queries = 0
+        g.profile_started = time.perf_counter()
+
+    def _after_request(self, response):
+        collector = getattr(g, "profile_collector", None)
+        if collector is None:
+            return response
+
+        total = time.perf_counter() - g.profile_started
+        if isinstance(collector, cProfile.Profile):
+            collector.disable()
+            _cprofile_lock.release()
+        else:
+            collector.stop()
+        g.profile_collector = None
+
+        try:
+            profile_id = self._write(collector, total, response.status_code)
+            response.headers["X-Profile-Id"] = profile_id
+        except Exception as e:
+            logger.error(f"Failed to write request profile: {str(e)}")
+        return response
+
+    def _teardown_request(self, exc) -> None:
+        # after_request is skipped on unhandled errors; never leave a profiler running
+        collector = getattr(g, "profile_collector", None)
+        if collector is None:
+            return
+        if isinstance(collector, cProfile.Profile):
+            collector.disable()
+            _cprofile_lock.release()
+        else:
+            collector.stop()
+        g.profile_collector = None
+
+    def _write(self, collector, total: float, status_code: int) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = f"{datetime.utcnow():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        base = os.path.join(self.directory, profile_id)
+
+        if isinstance(collector, cProfile.Profile):
+            collector.dump_stats(base + ".pstats")
+            artifact = profile_id + ".pstats"
+        else:
+            with open(base + ".collapsed", "w") as f:
+                f.write(collector.collapsed())
+            artifact = profile_id + ".collapsed"
+
+        phases = {name: round(seconds * 1000, 2) for name, seconds in g.profile_phases.items()}
+        phases["other"] = round(total * 1000 - sum(phases.values()), 2)
+        summary = {
+            "id": profile_id,
+            "method": request.method,
+            "path": request.path,
+            "status": status_code,
+            "total_ms": round(total * 1000, 2),
+            "phases_ms": phases,
+            "sql_statements": g.profile_queries,
+            "artifact": artifact,
+        }
+        with open(base + ".json", "w") as f:
+            json.dump(summary, f)
+
+        self._rotate()
+        return profile_id
+
+    def _rotate(self) -> None:
+        summaries = sorted(name for name in os.listdir(self.directory) if name.endswith(".json"))
+        for name in summaries[:-self.keep] if self.keep else []:
+            stem = name[:-len(".json")]
+            for suffix in (".json", ".pstats", ".collapsed"):
+                path = os.path.join(self.directory, stem + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def list_profiles(self) -> List[Dict[str, Any]]:
+        if not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if name.endswith(".json"):
+                with open(os.path.join(self.directory, name)) as f:
+                    profiles.append(json.load(f))
+        return profiles
+
+    def artifact_path(self, name: str) -> Optional[str]:
+        if os.path.basename(name) != name or not name.endswith((".json", ".pstats", ".collapsed")):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.exists(path) else None
@@ -0,0 +1,896 @@
+import os
+import sys
+import json
+import hashlib
+import sqlite3
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from message_codec import encode_content, decode_content, compress_text, decompress_text
+from email_cleaning import normalize_incoming
+from usage_ledger import LEDGER_DDL, LEDGER_INDEX_DDL
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Shared data-access layer for app.py and conversation_app.py
+# ----------------------------
+# One schema, owned by the versioned migrations below (PRAGMA user_version).
+# app.py's SQLAlchemy models map onto these tables; conversation_app.py uses
+# the Repository directly. Every method has a fixed statement budget
+# (QUERY_BUDGETS) that tests/test_repository.py checks.
+
+DEDUP_WINDOW = int(os.getenv("QUOTE_DEDUP_WINDOW", 20))  # earlier messages checked for quoted copies
+MESSAGE_COLUMNS = (
+    "id, conversation_id, content, content_z, clean_content, quoted_message_id, direction, sequence, created_at, "
+    "message_id"
+)
+
+
+def _add_column_if_missing(conn, table: str, column: str, ddl: str) -> None:
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in existing:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def _table_exists(conn, table: str) -> bool:
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).fetchone() is not None
+
+
+def _migration_base_tables(conn) -> None:
+    # conversation_app.py used to call the messages table 'messages'
+    if _table_exists(conn, "messages") and not _table_exists(conn, "conversation_messages"):
+        conn.execute("ALTER TABLE messages RENAME TO conversation_messages")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS contacts (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            email TEXT DEFAULT '',
+            designation TEXT DEFAULT '',
+            company TEXT DEFAULT '',
+            notes TEXT DEFAULT '',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY,
+            contact_id INTEGER NOT NULL,
+            title TEXT,
+            status TEXT DEFAULT 'active',
+            context_summary TEXT DEFAULT '',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (contact_id) REFERENCES contacts (id) ON DELETE CASCADE
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_messages (
+            id INTEGER PRIMARY KEY,
+            conversation_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            direction TEXT NOT NULL CHECK (direction IN ('sent', 'received')),
+            sequence INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+        )
+    """)
+
+
+def _migration_message_compression(conn) -> None:
+    _add_column_if_missing(conn, "conversation_messages", "content_z", "BLOB")
+    _add_column_if_missing(conn, "conversation_messages", "content_size", "INTEGER")
+
+
+def _migration_archive(conn) -> None:
+    _add_column_if_missing(conn, "conversations", "archived_at", "DATETIME")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_archives (
+            conversation_id INTEGER PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            last_message TEXT,
+            payload BLOB NOT NULL,
+            raw_size INTEGER,
+            archived_at DATETIME,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+        )
+    """)
+
+
+def _migration_clean_content(conn) -> None:
+    _add_column_if_missing(conn, "conversation_messages", "clean_content", "TEXT")
+    _add_column_if_missing(conn, "conversation_messages", "quoted_message_id", "INTEGER")
+
+
+def _migration_llm_tables(conn) -> None:
+    conn.execute(LEDGER_DDL)
+    conn.execute(LEDGER_INDEX_DDL)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS summary_chunks (
+            content_hash VARCHAR(64) PRIMARY KEY,
+            summary TEXT NOT NULL,
+            created_at DATETIME
+        )
+    """)
+
+
+def _migration_indexes(conn) -> None:
+    # Per-thread reads, MAX(sequence) and cursor pagination all walk this index
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_conversation_messages_conversation_sequence "
+        "ON conversation_messages (conversation_id, sequence)"
+    )
+    # Conversation lists per contact, newest first
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_conversations_contact_updated "
+        "ON conversations (contact_id, updated_at)"
+    )
+
+
+def _migration_contact_profile(conn) -> None:
+    _add_column_if_missing(conn, "contacts", "profile_summary", "TEXT")
+    _add_column_if_missing(conn, "contacts", "profile_source_hash", "VARCHAR(64)")
+    _add_column_if_missing(conn, "contacts", "profile_updated_at", "DATETIME")
+
+
+def _migration_mail_threading(conn) -> None:
+    # RFC 5322 Message-ID of ingested mail; In-Reply-To/References resolve through it
+    _add_column_if_missing(conn, "conversation_messages", "message_id", "TEXT")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_conversation_messages_message_id "
+        "ON conversation_messages (message_id) WHERE message_id IS NOT NULL"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_contacts_email_lower ON contacts (lower(email))")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS mail_ingest_state (
+            source TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            updated_at DATETIME
+        )
+    """)
+
+
+def _migration_ledger_tenant(conn) -> None:
+    # Conversation/contact ids repeat across tenant shards; the report groups by tenant first
+    _add_column_if_missing(conn, "llm_usage", "tenant_id", "TEXT")
+
+
+def _migration_archived_message_ids(conn) -> None:
+    # Archived messages only exist inside their blob; this keeps their Message-IDs
+    # findable so replies still thread and re-delivered mail is still a duplicate
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS archived_message_ids (
+            message_id TEXT NOT NULL,
+            conversation_id INTEGER NOT NULL,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id) ON DELETE CASCADE
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_archived_message_ids_message_id ON archived_message_ids (message_id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS ix_archived_message_ids_conversation ON archived_message_ids (conversation_id)"
+    )
+    for conversation_id, payload in conn.execute("SELECT conversation_id, payload FROM conversation_archives").fetchall():
+        conn.executemany(
+            "INSERT INTO archived_message_ids (message_id, conversation_id) VALUES (?, ?)",
+            [(m["message_id"], conversation_id) for m in decode_archive_payload(payload) if m.get("message_id")]
+        )
+
+
+def _migration_maintenance_tasks(conn) -> None:
+    # One-off background jobs (e.g. the compression backfill) claim a row here so
+    # only one process per database file runs them
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS maintenance_tasks (
+            task TEXT PRIMARY KEY,
+            owner TEXT,
+            claimed_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    """)
+
+
+def _migration_profile_digests(conn) -> None:
+    # JSON {"notes" | conversation id: digest}; lets a reply skip regeneration when
+    # only the thread being replied to changed
+    _add_column_if_missing(conn, "contacts", "profile_source_digests", "TEXT")
+
+
+# (version, description, migration). Never edit a released entry; append a new one.
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "base tables", _migration_base_tables),
+    (2, "compressed message bodies", _migration_message_compression),
+    (3, "conversation archive", _migration_archive),
+    (4, "cleaned message bodies", _migration_clean_content),
+    (5, "llm usage ledger and summary chunk cache", _migration_llm_tables),
+    (6, "read-path indexes", _migration_indexes),
+    (7, "contact relationship profile", _migration_contact_profile),
+    (8, "mail threading and ingestion state", _migration_mail_threading),
+    (9, "tenant column on the llm usage ledger", _migration_ledger_tenant),
+    (10, "message ids of archived threads", _migration_archived_message_ids),
+    (11, "maintenance task claims", _migration_maintenance_tasks),
+    (12, "per-thread contact profile digests", _migration_profile_digests),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn) -> int:
+    """Bring a database up to SCHEMA_VERSION. Safe on databases created by either app.
+
+    Each step runs in its own BEGIN IMMEDIATE transaction and re-reads
+    user_version once it holds the write lock, so workers starting together
+    apply every step exactly once instead of racing on the same ALTER TABLE.
+    """
+    for version, description, migration in MIGRATIONS:
+        if _schema_version(conn) >= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if _schema_version(conn) >= version:
+                # Another process applied it while we waited for the lock
+                conn.rollback()
+                continue
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Applied schema migration {version}: {description}")
+    return max(_schema_version(conn), SCHEMA_VERSION)
+
+
+def configure_connection(conn) -> None:
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    conn.execute("PRAGMA busy_timeout=30000")
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+    configure_connection(conn)
+    migrate(conn)
+    return conn
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat(sep=" ")
+
+
+def _iso(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value).replace(" ", "T", 1)
+
+
+def encode_archive_payload(messages: List[Dict[str, Any]]) -> Tuple[bytes, int]:
+    serialized = json.dumps(messages, ensure_ascii=False)
+    return compress_text(serialized), len(serialized.encode("utf-8"))
+
+
+def decode_archive_payload(payload: bytes) -> List[Dict[str, Any]]:
+    return json.loads(decompress_text(payload))
+
+
+class Repository:
+    """Bulk-friendly reads and writes over one DB-API (sqlite3) connection"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    # ----------------------------
+    # Contacts
+    # ----------------------------
+    def add_contact(self, name: str, email: str = "", designation: str = "", company: str = "",
+                    notes: str = "") -> int:
+        cursor = self.conn.execute(
+            "INSERT INTO contacts (name, email, designation, company, notes, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (name, email or "", designation or "", company or "", notes or "", _now())
+        )
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def get_contact(self, contact_id: int) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute(
+            "SELECT id, name, email, designation, company, notes, created_at FROM contacts WHERE id = ?",
+            (contact_id,)
+        ).fetchone()
+        return self._contact(row) if row else None
+
+    def list_contacts(self) -> List[Dict[str, Any]]:
+        """All contacts with their conversation counts, in one statement"""
+        rows = self.conn.execute("""
+            SELECT ct.id, ct.name, ct.email, ct.designation, ct.company, ct.notes, ct.created_at,
+                   COUNT(c.id) AS conversation_count
+            FROM contacts ct
+            LEFT JOIN conversations c ON c.contact_id = ct.id
+            GROUP BY ct.id
+            ORDER BY ct.name
+        """).fetchall()
+        return [dict(self._contact(row[:7]), conversation_count=row[7]) for row in rows]
+
+    def contact_profile_sources(self, contact_id: int, max_conversations: int) -> Optional[Dict[str, Any]]:
+        """Contact notes, stored profile (with its per-input digests) and the summaries of its most recently active threads"""
+        rows = self.conn.execute("""
+            SELECT ct.name, ct.notes, ct.profile_summary, ct.profile_source_digests,
+                   c.id, c.title, c.context_summary
+            FROM contacts ct
+            LEFT JOIN (
+                SELECT id, contact_id, title, context_summary, updated_at FROM conversations
+                WHERE contact_id = ? AND context_summary IS NOT NULL AND context_summary != ''
+                ORDER BY updated_at DESC LIMIT ?
+            ) c ON c.contact_id = ct.id
+            WHERE ct.id = ?
+            ORDER BY c.updated_at DESC
+        """, (contact_id, max_conversations, contact_id)).fetchall()
+        if not rows:
+            return None
+        name, notes, profile_summary, profile_source_digests = rows[0][:4]
+        return {
+            "contact_id": contact_id,
+            "name": name,
+            "notes": notes,
+            "profile_summary": profile_summary,
+            "profile_source_digests": json.loads(profile_source_digests) if profile_source_digests else None,
+            "summaries": [(conv_id, title, summary) for *_, conv_id, title, summary in rows if conv_id is not None],
+        }
+
+    def save_contact_profile(self, contact_id: int, profile_summary: str, source_digests: Dict[str, str]) -> None:
+        """Store a profile with the digests of the inputs it was built from (see contact_profile.py)"""
+        digests = json.dumps(source_digests, sort_keys=True)
+        self.conn.execute(
+            "UPDATE contacts SET profile_summary = ?, profile_source_hash = ?, profile_source_digests = ?, "
+            "profile_updated_at = ? WHERE id = ?",
+            (profile_summary, hashlib.sha256(digests.encode("utf-8")).hexdigest(), digests, _now(), contact_id)
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def _contact(row) -> Dict[str, Any]:
+        contact_id, name, email, designation, company, notes, created_at = row
+        return {
+            "id": contact_id,
+            "name": name,
+            "email": email,
+            "designation": designation,
+            "company": company,
+            "notes": notes,
+            "created_at": _iso(created_at),
+        }
+
+    # ----------------------------
+    # Conversations
+    # ----------------------------
+    def add_conversation(self, contact_id: int, title: str, status: str = "active") -> int:
+        now = _now()
+        cursor = self.conn.execute(
+            "INSERT INTO conversations (contact_id, title, status, context_summary, created_at, updated_at) "
+            "VALUES (?, ?, ?, '', ?, ?)",
+            (contact_id, title, status, now, now)
+        )
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def get_conversation(self, conversation_id: int) -> Optional[Dict[str, Any]]:
+        """Conversation header joined with its contact"""
+        row = self.conn.execute("""
+            SELECT c.id, c.contact_id, c.title, c.status, c.context_summary, c.created_at, c.updated_at,
+                   c.archived_at, ct.name, ct.email, ct.designation, ct.company,
+                   (SELECT MAX(sequence) FROM conversation_messages m WHERE m.conversation_id = c.id)
+            FROM conversations c
+            JOIN contacts ct ON ct.id = c.contact_id
+            WHERE c.id = ?
+        """, (conversation_id,)).fetchone()
+        if row is None:
+            return None
+        (conv_id, contact_id, title, status, context_summary, created_at, updated_at, archived_at,
+         name, email, designation, company, latest_sequence) = row
+        return {
+            "id": conv_id,
+            "contact_id": contact_id,
+            "title": title,
+            "status": status,
+            "context_summary": context_summary,
+            "created_at": _iso(created_at),
+            "updated_at": _iso(updated_at),
+            "archived": archived_at is not None,
+            "latest_sequence": latest_sequence,
+            "contact": {
+                "id": contact_id,
+                "name": name,
+                "email": email,
+                "designation": designation,
+                "company": company,
+            },
+        }
+
+    def list_conversations(self, contact_id: Optional[int] = None,
+                           include_archived: bool = False) -> List[Dict[str, Any]]:
+        """Conversations with contact, message count and last message, in one statement"""
+        where, params = [], []
+        if contact_id is not None:
+            where.append("c.contact_id = ?")
+            params.append(contact_id)
+        if not include_archived:
+            where.append("c.archived_at IS NULL")
+        where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+
+        rows = self.conn.execute(f"""
+            SELECT c.id, c.contact_id, c.title, c.status, c.context_summary, c.created_at, c.updated_at,
+                   c.archived_at, ct.name, ct.company,
+                   (SELECT COUNT(*) FROM conversation_messages m WHERE m.conversation_id = c.id),
+                   lm.content, lm.content_z, lm.created_at,
+                   a.message_count, a.last_message
+            FROM conversations c
+            JOIN contacts ct ON ct.id = c.contact_id
+            LEFT JOIN conversation_messages lm ON lm.id = (
+                SELECT id FROM conversation_messages
+                WHERE conversation_id = c.id ORDER BY sequence DESC LIMIT 1
+            )
+            LEFT JOIN conversation_archives a ON a.conversation_id = c.id
+            {where_sql}
+            ORDER BY c.updated_at DESC
+        """, params).fetchall()
+
+        result = []
+        for (conv_id, conv_contact_id, title, status, context_summary, created_at, updated_at, archived_at,
+             contact_name, contact_company, message_count, last_content, last_content_z, last_created_at,
+             archived_count, archived_preview) in rows:
+            if archived_at is not None:
+                message_count = archived_count or 0
+                last_message = archived_preview
+            else:
+                last_message = (
+                    decode_content(last_content, last_content_z)[:100]
+                    if last_content is not None else None
+                )
+            result.append({
+                "id": conv_id,
+                "contact_id": conv_contact_id,
+                "title": title,
+                "status": status,
+                "archived": archived_at is not None,
+                "context_summary": context_summary,
+                "contact_name": contact_name,
+                "contact_company": contact_company,
+                "created_at": _iso(created_at),
+                "updated_at": _iso(updated_at),
+                "message_count": message_count,
+                "last_message": last_message,
+                "last_message_time": _iso(last_created_at),
+            })
+        return result
+
+    # ----------------------------
+    # Messages
+    # ----------------------------
+    def get_messages(self, conversation_id: int, since_sequence: Optional[int] = None,
+                     before_sequence: Optional[int] = None,
+                     limit: Optional[int] = None,
+                     archived: Optional[bool] = None) -> Tuple[List[Dict[str, Any]], bool]:
+        """Messages in sequence order plus a has-more flag.
+
+        ``since_sequence`` returns newer messages (delta sync); ``limit`` without
+        it returns the newest page, optionally older than ``before_sequence``.
+        Archived threads are read from their archive blob. Callers that already
+        hold the conversation header pass its ``archived`` flag: otherwise an
+        empty result costs a second statement to look for an archive.
+        """
+        if archived:
+            return self._page(self._archived_messages(conversation_id) or [], since_sequence, before_sequence, limit)
+        where, params = ["conversation_id = ?"], [conversation_id]
+        if since_sequence is not None:
+            where.append("sequence > ?")
+            params.append(since_sequence)
+        if before_sequence is not None:
+            where.append("sequence < ?")
+            params.append(before_sequence)
+        newest_first = limit is not None and since_sequence is None
+        sql = (
+            f"SELECT {MESSAGE_COLUMNS} FROM conversation_messages WHERE {' AND '.join(where)} "
+            f"ORDER BY sequence {'DESC' if newest_first else 'ASC'}"
+        )
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+
+        rows = self.conn.execute(sql, params).fetchall()
+        if not rows and archived is None:
+            archived_messages = self._archived_messages(conversation_id)
+            if archived_messages is not None:
+                return self._page(archived_messages, since_sequence, before_sequence, limit)
+
+        has_more = limit is not None and len(rows) > limit
+        rows = rows[:limit] if limit is not None else rows
+        if newest_first:
+            rows = list(reversed(rows))
+        return [self._message(row) for row in rows], has_more
+
+    def recent_prompt_messages(self, conversation_id: int, limit: int) -> List[Tuple[str, str]]:
+        """(direction, prompt text) of the last ``limit`` messages, oldest first"""
+        rows = self.conn.execute(
+            "SELECT direction, content, content_z, clean_content FROM conversation_messages "
+            "WHERE conversation_id = ? ORDER BY sequence DESC LIMIT ?",
+            (conversation_id, limit)
+        ).fetchall()
+        return [
+            (direction, clean_content or decode_content(content, content_z))
+            for direction, content, content_z, clean_content in reversed(rows)
+        ]
+
+    def add_message(self, conversation_id: int, content: str, direction: str,
+                    normalize: bool = True) -> Dict[str, Any]:
+        """Insert one message; thin wrapper over ``add_messages``"""
+        return self.add_messages([{
+            "conversation_id": conversation_id,
+            "content": content,
+            "direction": direction,
+            "normalize": normalize,
+        }])[0]
+
+    def add_messages(self, items: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Insert many messages (any mix of conversations) in one transaction.
+
+        Each item has conversation_id, content, direction and optionally
+        normalize (quote/signature stripping, default True), created_at and
+        message_id (the email's Message-ID header).
+        Sequences continue each conversation in item order. Archived
+        conversations are restored first, so new messages continue their
+        archived history. Returns the stored messages with their ids and
+        sequences. Issues a fixed number of statements regardless of how many
+        items or conversations are involved (plus a few per restored thread).
+        """
+        if not items:
+            return []
+        conversation_ids = sorted({item["conversation_id"] for item in items})
+        placeholders = ", ".join("?" for _ in conversation_ids)
+
+        # Take the write lock up front so sequences and ids can be assigned locally
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            archived = self.conn.execute(
+                f"SELECT id FROM conversations WHERE id IN ({placeholders}) AND archived_at IS NOT NULL",
+                conversation_ids
+            ).fetchall()
+            for (archived_id,) in archived:
+                self._restore_archived(archived_id)
+
+            window = self.conn.execute(f"""
+                SELECT id, conversation_id, content, content_z, clean_content, sequence, NULL
+                FROM (
+                    SELECT id, conversation_id, content, content_z, clean_content, sequence,
+                           ROW_NUMBER() OVER (PARTITION BY conversation_id ORDER BY sequence DESC) AS rn
+                    FROM conversation_messages
+                    WHERE conversation_id IN ({placeholders})
+                )
+                WHERE rn <= ?
+                UNION ALL
+                -- one extra row carrying the current max id
+                SELECT NULL, NULL, NULL, NULL, NULL, NULL, MAX(id) FROM conversation_messages
+                ORDER BY 2, 6
+            """, (*conversation_ids, DEDUP_WINDOW)).fetchall()
+
+            max_id = 0
+            earlier: Dict[int, List[Tuple[int, str, Optional[str]]]] = {cid: [] for cid in conversation_ids}
+            last_sequence: Dict[int, int] = {cid: 0 for cid in conversation_ids}
+            for msg_id, conv_id, body, body_z, clean, sequence, table_max_id in window:
+                max_id = max(max_id, table_max_id or 0)
+                if msg_id is None:
+                    continue
+                earlier[conv_id].append((msg_id, decode_content(body, body_z), clean))
+                last_sequence[conv_id] = max(last_sequence[conv_id], sequence or 0)
+
+            now = _now()
+            rows, stored = [], []
+            for item in items:
+                conv_id = item["conversation_id"]
+                max_id += 1
+                last_sequence[conv_id] += 1
+                if item.get("normalize", True):
+                    clean_content, quoted_message_id = normalize_incoming(
+                        item["content"], earlier[conv_id][-DEDUP_WINDOW:]
+                    )
+                else:
+                    clean_content, quoted_message_id = None, None
+                text, blob, size = encode_content(item["content"])
+                created_at = item.get("created_at") or now
+                rows.append((max_id, conv_id, text, blob, size, clean_content, quoted_message_id,
+                             item["direction"], last_sequence[conv_id], created_at, item.get("message_id")))
+                earlier[conv_id].append((max_id, item["content"], clean_content))
+                stored.append({
+                    "id": max_id,
+                    "conversation_id": conv_id,
+                    "content": item["content"],
+                    "clean_content": clean_content,
+                    "quoted_message_id": quoted_message_id,
+                    "direction": item["direction"],
+                    "sequence": last_sequence[conv_id],
+                    "created_at": _iso(created_at),
+                    "message_id": item.get("message_id"),
+                })
+
+            self.conn.executemany(
+                "INSERT INTO conversation_messages (id, conversation_id, content, content_z, content_size, "
+                "clean_content, quoted_message_id, direction, sequence, created_at, message_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self.conn.executemany(
+                "UPDATE conversations SET updated_at = ? WHERE id = ?",
+                [(now, conv_id) for conv_id in conversation_ids]
+            )
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return stored
+
+    # ----------------------------
+    # Mail ingestion lookups
+    # ----------------------------
+    def find_contacts_by_email(self, addresses: Sequence[str]) -> Dict[str, int]:
+        """Lower-cased address -> contact id (oldest contact wins on duplicates)"""
+        addresses = sorted({address.lower() for address in addresses if address})
+        if not addresses:
+            return {}
+        rows = self.conn.execute(
+            f"SELECT lower(email), MIN(id) FROM contacts WHERE lower(email) IN ({', '.join('?' for _ in addresses)}) "
+            "GROUP BY lower(email)",
+            addresses
+        ).fetchall()
+        return dict(rows)
+
+    def find_conversation_by_message_ids(self, message_ids: Sequence[str]) -> Optional[int]:
+        """Conversation of the newest stored message whose Message-ID is in ``message_ids``.
+
+        Archived threads are searched too (through archived_message_ids); hot
+        messages win over archived ones.
+        """
+        if not message_ids:
+            return None
+        placeholders = ", ".join("?" for _ in message_ids)
+        row = self.conn.execute(
+            f"SELECT conversation_id FROM ("
+            f"SELECT conversation_id, id AS rank FROM conversation_messages WHERE message_id IN ({placeholders}) "
+            f"UNION ALL "
+            f"SELECT conversation_id, 0 FROM archived_message_ids WHERE message_id IN ({placeholders})"
+            f") ORDER BY rank DESC LIMIT 1",
+            [*message_ids, *message_ids]
+        ).fetchone()
+        return row[0] if row else None
+
+    def find_conversation_by_title(self, contact_id: int, title: str) -> Optional[int]:
+        """Most recently active conversation with this contact whose title matches (case-insensitive)"""
+        row = self.conn.execute(
+            "SELECT id FROM conversations WHERE contact_id = ? AND lower(title) = lower(?) "
+            "ORDER BY updated_at DESC LIMIT 1",
+            (contact_id, title)
+        ).fetchone()
+        return row[0] if row else None
+
+    # ----------------------------
+    # Archive (cold tier)
+    # ----------------------------
+    def is_archived(self, conversation_id: int) -> bool:
+        row = self.conn.execute(
+            "SELECT archived_at IS NOT NULL FROM conversations WHERE id = ?", (conversation_id,)
+        ).fetchone()
+        return bool(row and row[0])
+
+    def archive_conversation(self, conversation_id: int) -> int:
+        """Move a thread's messages into one compressed conversation_archives row; returns the count"""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute(
+                "SELECT archived_at FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+            if row is None or row[0] is not None:
+                self.conn.rollback()
+                return 0
+            rows = self.conn.execute(
+                f"SELECT {MESSAGE_COLUMNS} FROM conversation_messages WHERE conversation_id = ? ORDER BY sequence",
+                (conversation_id,)
+            ).fetchall()
+            messages = [self._message(row) for row in rows]
+            for message in messages:
+                message.pop("conversation_id")
+            payload, raw_size = encode_archive_payload(messages)
+            now = _now()
+            self.conn.execute(
+                "INSERT INTO conversation_archives (conversation_id, message_count, last_message, payload, "
+                "raw_size, archived_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation_id, len(messages), messages[-1]["content"][:100] if messages else None,
+                 payload, raw_size, now)
+            )
+            self.conn.executemany(
+                "INSERT INTO archived_message_ids (message_id, conversation_id) VALUES (?, ?)",
+                [(m["message_id"], conversation_id) for m in messages if m["message_id"]]
+            )
+            self.conn.execute("DELETE FROM conversation_messages WHERE conversation_id = ?", (conversation_id,))
+            # updated_at is left alone: archiving is not activity
+            self.conn.execute("UPDATE conversations SET archived_at = ? WHERE id = ?", (now, conversation_id))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        return len(messages)
+
+    def unarchive_conversation(self, conversation_id: int) -> None:
+        """Move an archived thread's messages back into conversation_messages.
+
+        Ids freed by archiving are handed out again by later inserts, so the
+        restored messages get fresh ids (past the current maximum) and their
+        quoted_message_id references are remapped to match.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._restore_archived(conversation_id)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def _restore_archived(self, conversation_id: int) -> None:
+        """unarchive_conversation's statements, inside the caller's write transaction"""
+        messages = self._archived_messages(conversation_id) or []
+        max_id = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM conversation_messages").fetchone()[0]
+        new_ids = {m["id"]: max_id + offset for offset, m in enumerate(messages, start=1)}
+        self.conn.executemany(
+            "INSERT INTO conversation_messages (id, conversation_id, content, content_z, content_size, "
+            "clean_content, quoted_message_id, direction, sequence, created_at, message_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (new_ids[m["id"]], conversation_id, *encode_content(m["content"]), m.get("clean_content"),
+                 new_ids.get(m.get("quoted_message_id")), m["direction"], m["sequence"],
+                 m["created_at"].replace("T", " ", 1), m.get("message_id"))
+                for m in messages
+            ]
+        )
+        self.conn.execute("DELETE FROM conversation_archives WHERE conversation_id = ?", (conversation_id,))
+        self.conn.execute("DELETE FROM archived_message_ids WHERE conversation_id = ?", (conversation_id,))
+        self.conn.execute(
+            "UPDATE conversations SET archived_at = NULL, "
+            "status = CASE WHEN status = 'archived' THEN 'active' ELSE status END WHERE id = ?",
+            (conversation_id,)
+        )
+
+    # ----------------------------
+    # Mail ingestion state
+    # ----------------------------
+    def get_ingest_position(self, source: str) -> int:
+        row = self.conn.execute("SELECT position FROM mail_ingest_state WHERE source = ?", (source,)).fetchone()
+        return row[0] if row else 0
+
+    def save_ingest_position(self, source: str, position: int) -> None:
+        self.conn.execute(
+            "INSERT INTO mail_ingest_state (source, position, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(source) DO UPDATE SET position = excluded.position, updated_at = excluded.updated_at",
+            (source, position, _now())
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def _page(messages: List[Dict[str, Any]], since_sequence: Optional[int], before_sequence: Optional[int],
+              limit: Optional[int]) -> Tuple[List[Dict[str, Any]], bool]:
+        """Apply get_messages' filters to an in-memory (archived) message list"""
+        if since_sequence is not None:
+            messages = [m for m in messages if m["sequence"] > since_sequence]
+        if before_sequence is not None:
+            messages = [m for m in messages if m["sequence"] < before_sequence]
+        has_more = limit is not None and len(messages) > limit
+        if has_more:
+            messages = messages[:limit] if since_sequence is not None else messages[-limit:]
+        return messages, has_more
+
+    def _archived_messages(self, conversation_id: int) -> Optional[List[Dict[str, Any]]]:
+        row = self.conn.execute(
+            "SELECT payload FROM conversation_archives WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+        return decode_archive_payload(row[0]) if row else None
+
+    @staticmethod
+    def _message(row) -> Dict[str, Any]:
+        (msg_id, conversation_id, content, content_z, clean_content, quoted_message_id, direction, sequence,
+         created_at, message_id) = row
+        return {
+            "id": msg_id,
+            "conversation_id": conversation_id,
+            "content": decode_content(content, content_z),
+            "clean_content": clean_content,
+            "quoted_message_id": quoted_message_id,
+            "direction": direction,
+            "sequence": sequence,
+            "created_at": _iso(created_at),
+            "message_id": message_id,
+        }
+
+# ----------------------------
+# Query-count harness
+# ----------------------------
+# Maximum statements each operation may issue, independent of data size
+# (enforced by tests/test_repository.py).
+QUERY_BUDGETS = {
+    "list_contacts": 1,
+    "get_contact": 1,
+    "contact_profile_sources": 1,
+    "save_contact_profile": 1,
+    "list_conversations": 1,
+    "get_conversation": 1,
+    "get_messages": 1,
+    "get_messages_page": 1,
+    "get_messages_empty_delta": 1,
+    "recent_prompt_messages": 1,
+    "find_contacts_by_email": 1,
+    "find_conversation_by_message_ids": 1,
+    "find_conversation_by_title": 1,
+    "add_contact": 1,
+    "add_conversation": 1,
+    "add_message": 5,  # BEGIN IMMEDIATE, archived check, window read, insert, updated_at bump
+    "add_messages_bulk": 5,  # same statements for any number of messages/conversations
+}
+
+
+class CountingConnection:
+    """Proxy that counts statements issued through execute/executemany"""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.statements: List[str] = []
+
+    def execute(self, sql, *args, **kwargs):
+        self.statements.append(" ".join(sql.split()))
+        return self._conn.execute(sql, *args, **kwargs)
+
+    def executemany(self, sql, *args, **kwargs):
+        self.statements.append(" ".join(sql.split()))
+        return self._conn.executemany(sql, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+@contextmanager
+def count_statements(repo: Repository) -> Iterator[List[str]]:
+    """Temporarily count the statements ``repo`` issues; yields the live statement list"""
+    original = repo.conn
+    counting = CountingConnection(original)
+    repo.conn = counting
+    try:
+        yield counting.statements
+    finally:
+        repo.conn = original
+
+
+def assert_query_budget(repo: Repository, operation: str, call: Callable[[], Any]) -> int:
+    with count_statements(repo) as statements:
+        call()
+    budget = QUERY_BUDGETS[operation]
+    if len(statements) > budget:
+        raise AssertionError(
+            f"{operation} issued {len(statements)} statements (budget {budget}):\n  " + "\n  ".join(statements)
+        )
+    return len(statements)
+
+
+if __name__ == "__main__":
+    # python repository.py <db-path>   -> migrate a database to SCHEMA_VERSION
+    # (statement budgets and the archive round trip are checked by tests/test_repository.py)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    if len(sys.argv) != 2:
+        print(f"usage: python {sys.argv[0]} <db-path>")
+        sys.exit(2)
+    database = sqlite3.connect(sys.argv[1])
+    print(f"{sys.argv[1]} is at schema version {migrate(database)}")
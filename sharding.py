@@ -0,0 +1,200 @@
+import os
+import re
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Per-tenant SQLite shards
+# ----------------------------
+# Each tenant (user or workspace) gets its own SQLite file, so writers only
+# contend with their own tenant's writer lock. Shards are opened on first use,
+# migrated lazily by the open callback, and kept in an LRU-bounded pool.
+
+TENANT_HEADER = os.getenv("TENANT_HEADER", "X-Tenant-ID")
+SHARD_DIR = os.getenv("TENANT_SHARD_DIR")  # sharding is off unless set
+MAX_OPEN_SHARDS = int(os.getenv("TENANT_MAX_OPEN_SHARDS", 32))
+FAN_OUT_PARALLELISM = int(os.getenv("TENANT_FAN_OUT_PARALLELISM", 4))
+DEFAULT_TENANT = "default"
+SHARD_SUFFIX = ".db"
+
+TENANT_ID = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_-]{0,63}$")
+
+
+def validate_tenant(tenant_id: Optional[str]) -> str:
+    """Normalize a tenant id; it becomes a file name, so only a safe charset is allowed"""
+    if not tenant_id:
+        return DEFAULT_TENANT
+    tenant_id = tenant_id.strip()
+    if not TENANT_ID.match(tenant_id):
+        raise ValueError("Tenant id must be 1-64 letters, digits, '-' or '_'")
+    return tenant_id
+
+
+def shard_file(directory: str, tenant_id: str) -> str:
+    return os.path.join(directory, validate_tenant(tenant_id) + SHARD_SUFFIX)
+
+
+class _Shard:
+    __slots__ = ("handle", "leases")
+
+    def __init__(self, handle: Any):
+        self.handle = handle
+        self.leases = 0
+
+
+class ShardRouter:
+    """Maps tenants to shard files and keeps at most ``max_open`` shard handles open.
+
+    ``open_shard(path)`` returns a handle (an engine, a Repository, ...) and
+    must create and migrate the file if needed; ``close_shard(handle)``
+    releases it. Handles are leased while in use and only idle ones are
+    evicted, so eviction never pulls a connection out from under a request
+    (the pool briefly exceeds ``max_open`` if every open shard is leased).
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        open_shard: Callable[[str], Any],
+        close_shard: Callable[[Any], None],
+        max_open: int = MAX_OPEN_SHARDS,
+        default_path: Optional[str] = None,
+    ):
+        self.directory = directory
+        self.open_shard = open_shard
+        self.close_shard = close_shard
+        self.max_open = max(1, max_open)
+        self.default_path = default_path
+        self.opened = 0
+        self.evictions = 0
+        self._shards: "OrderedDict[str, _Shard]" = OrderedDict()
+        self._lock = threading.Lock()
+        # One lock per tenant so a slow first open/migration does not block other tenants
+        self._open_locks: Dict[str, threading.Lock] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def shard_path(self, tenant_id: str) -> str:
+        tenant_id = validate_tenant(tenant_id)
+        if tenant_id == DEFAULT_TENANT and self.default_path:
+            return self.default_path
+        return shard_file(self.directory, tenant_id)
+
+    def acquire(self, tenant_id: str) -> Any:
+        """Lease the tenant's shard handle, opening (and migrating) it on first use"""
+        tenant_id = validate_tenant(tenant_id)
+        with self._lock:
+            shard = self._lease_open(tenant_id)
+            if shard is not None:
+                return shard.handle
+            open_lock = self._open_locks.setdefault(tenant_id, threading.Lock())
+
+        with open_lock:
+            with self._lock:
+                shard = self._lease_open(tenant_id)
+                if shard is not None:
+                    return shard.handle
+            handle = self.open_shard(self.shard_path(tenant_id))
+            with self._lock:
+                shard = _Shard(handle)
+                shard.leases = 1
+                self._shards[tenant_id] = shard
+                self.opened += 1
+                to_close = self._evict_idle()
+        for idle in to_close:
+            self._close(idle)
+        return handle
+
+    def release(self, tenant_id: str) -> None:
+        tenant_id = validate_tenant(tenant_id)
+        with self._lock:
+            shard = self._shards.get(tenant_id)
+            if shard is not None:
+                shard.leases -= 1
+            to_close = self._evict_idle()
+        for idle in to_close:
+            self._close(idle)
+
+    @contextmanager
+    def lease(self, tenant_id: str) -> Iterator[Any]:
+        handle = self.acquire(tenant_id)
+        try:
+            yield handle
+        finally:
+            self.release(tenant_id)
+
+    def tenants(self) -> List[str]:
+        """Every tenant with a shard on disk (plus the default tenant when it has a path)"""
+        found = {
+            name[:-len(SHARD_SUFFIX)]
+            for name in os.listdir(self.directory)
+            if name.endswith(SHARD_SUFFIX) and TENANT_ID.match(name[:-len(SHARD_SUFFIX)])
+        }
+        if self.default_path:
+            found.add(DEFAULT_TENANT)
+        return sorted(found)
+
+    def fan_out(self, call: Callable[[str, Any], Any], tenants: Optional[Iterable[str]] = None,
+                parallelism: int = FAN_OUT_PARALLELISM) -> Dict[str, Dict[str, Any]]:
+        """Run ``call(tenant_id, handle)`` on each shard.
+
+        Returns {tenant: {"result": ...}} or {tenant: {"error": ...}} so one
+        broken shard does not hide the others.
+        """
+        tenants = list(tenants) if tenants is not None else self.tenants()
+
+        def run(tenant_id: str) -> Dict[str, Any]:
+            try:
+                with self.lease(tenant_id) as handle:
+                    return {"result": call(tenant_id, handle)}
+            except Exception as e:
+                logger.error(f"Shard fan-out failed for tenant {tenant_id}: {str(e)}")
+                return {"error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(tenants) or 1))) as pool:
+            return dict(zip(tenants, pool.map(run, tenants)))
+
+    def close_all(self) -> None:
+        with self._lock:
+            shards, self._shards = list(self._shards.values()), OrderedDict()
+        for shard in shards:
+            self._close(shard.handle)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "open": len(self._shards),
+                "max_open": self.max_open,
+                "leased": sum(1 for shard in self._shards.values() if shard.leases),
+                "opened": self.opened,
+                "evictions": self.evictions,
+            }
+
+    def _lease_open(self, tenant_id: str) -> Optional[_Shard]:
+        shard = self._shards.get(tenant_id)
+        if shard is not None:
+            shard.leases += 1
+            self._shards.move_to_end(tenant_id)
+        return shard
+
+    def _evict_idle(self) -> List[Any]:
+        """Drop least recently used idle shards beyond max_open; returns the handles to close"""
+        to_close = []
+        for tenant_id in list(self._shards):
+            if len(self._shards) <= self.max_open:
+                break
+            if self._shards[tenant_id].leases == 0:
+                to_close.append(self._shards.pop(tenant_id).handle)
+                self.evictions += 1
+        return to_close
+
+    def _close(self, handle: Any) -> None:
+        try:
+            self.close_shard(handle)
+        except Exception as e:
+            logger.error(f"Failed to close shard handle: {str(e)}")
@@ -0,0 +1,260 @@
+import os
+import re
+import time
+import asyncio
+import sqlite3
+import smtplib
+import threading
+from concurrent.futures import Future
+from email.message import EmailMessage
+
+import pytest
+
+import repository
+from repository import Repository
+from mail_ingest import MBOX_SETTLE_SECONDS, MailIngestor, MaildirSource, MboxSource, SMTPListener
+
+OWN_ADDRESS = "me@example.com"
+
+
+def mail(sender: str, subject: str, body: str, message_id: str, in_reply_to: str = "",
+         to: str = OWN_ADDRESS) -> EmailMessage:
+    message = EmailMessage()
+    message["From"], message["To"], message["Subject"] = sender, to, subject
+    if message_id:
+        message["Message-ID"] = message_id
+    message["Date"] = "Mon, 03 Jun 2024 10:00:00 +0000"
+    if in_reply_to:
+        message["In-Reply-To"] = message["References"] = in_reply_to
+    message.set_content(body)
+    return message
+
+
+def append_mbox(path: str, *messages: EmailMessage) -> None:
+    with open(path, "ab") as f:
+        for message in messages:
+            escaped = re.sub(rb"^(>*From )", rb">\1", message.as_bytes(), flags=re.MULTILINE)  # mboxrd
+            f.write(b"From ada@example.com Mon Jun  3 10:00:00 2024\n" + escaped + b"\n")
+    os.utime(path, (time.time() - MBOX_SETTLE_SECONDS - 1,) * 2)
+
+
+def drop_maildir(maildir: MaildirSource, name: str, message: EmailMessage) -> None:
+    with open(os.path.join(maildir.path, "new", name), "wb") as f:
+        f.write(message.as_bytes())
+
+
+class FailingWriter:
+    """Stands in for a writer whose commits fail (disk full, database locked, ...)"""
+
+    def submit(self, *args, **kwargs) -> Future:
+        future: Future = Future()
+        future.set_exception(sqlite3.OperationalError("database is locked"))
+        return future
+
+
+class PoisonWriter:
+    """Fails only messages containing ``marker``: one bad message among good ones"""
+
+    def __init__(self, writer, marker: str):
+        self.writer, self.marker = writer, marker
+
+    def submit(self, conversation_id: int, content: str, *args, **kwargs) -> Future:
+        if self.marker in content:
+            return FailingWriter().submit()
+        return self.writer.submit(conversation_id, content, *args, **kwargs)
+
+
+class Mailbox:
+    """A temporary database with one contact, an ingestor, an SMTP listener, an mbox and a maildir"""
+
+    def __init__(self, tmp: str):
+        self.db_path = os.path.join(tmp, "ingest.db")
+        self.repo = Repository(repository.connect(self.db_path))
+        self.contact_id = self.repo.add_contact("Ada Lovelace", "Ada@Example.com")
+        self.ingestor = MailIngestor(self.db_path, own_addresses=[OWN_ADDRESS])
+        self.mbox_path = os.path.join(tmp, "inbox.mbox")
+        self.mbox = MboxSource(self.mbox_path)
+        self.maildir = MaildirSource(os.path.join(tmp, "Maildir"))
+        self.new_dir = os.path.join(self.maildir.path, "new")
+
+        self.loop = asyncio.new_event_loop()
+        self.port = self.loop.run_until_complete(SMTPListener(self.ingestor, "127.0.0.1", 0).start())
+        threading.Thread(target=self.loop.run_forever, name="test-smtp", daemon=True).start()
+
+    def send(self, *messages: EmailMessage) -> None:
+        with smtplib.SMTP("127.0.0.1", self.port) as client:
+            for message in messages:
+                client.send_message(message)
+
+    def conversations(self):
+        conversations = self.repo.list_conversations(contact_id=self.contact_id, include_archived=True)
+        return {c["title"]: c["id"] for c in conversations}
+
+    def messages(self, title: str):
+        return self.repo.get_messages(self.conversations()[title])[0]
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+@pytest.fixture
+def mailbox(tmp_path):
+    box = Mailbox(str(tmp_path))
+    yield box
+    box.close()
+
+
+@pytest.fixture
+def delivered(mailbox):
+    """Mail delivered over SMTP, then an mbox and a maildir, into two threads"""
+    mailbox.send(
+        mail("Ada <ada@example.com>", "Engine notes", "Here are my notes on the engine.\n.leading dot",
+             "<1@example.com>"),
+        mail(OWN_ADDRESS, "Re: Engine notes", "Thanks, reading them now.", "<2@example.com>", "<1@example.com>",
+             to="Ada <ada@example.com>"),
+        mail("stranger@example.org", "Hello", "Spam", "<3@example.org>"),
+    )
+    append_mbox(
+        mailbox.mbox_path,
+        mail("ada@example.com", "Retitled", "From the mbox, in thread.", "<4@example.com>", "<2@example.com>"),
+        mail("ada@example.com", "Travel plans", "A new topic.", "<5@example.com>"),
+    )
+    mailbox.mbox.poll(mailbox.ingestor)
+    mailbox.mbox.poll(mailbox.ingestor)  # nothing new: offset was committed
+    drop_maildir(mailbox.maildir, "a", mail("ada@example.com", "Re: Travel plans", "Maildir reply.", "<6@example.com>"))
+    drop_maildir(mailbox.maildir, "b", mail("ada@example.com", "Engine notes", "Duplicate", "<1@example.com>"))
+    mailbox.maildir.poll(mailbox.ingestor)
+    return mailbox
+
+
+# ----------------------------
+# Delivery and threading
+# ----------------------------
+def test_conversations_by_subject(delivered):
+    assert sorted(delivered.conversations()) == ["Engine notes", "Travel plans"]
+
+
+def test_replies_threaded_by_headers(delivered):
+    messages = delivered.messages("Engine notes")
+    assert [m["message_id"] for m in messages] == ["<1@example.com>", "<2@example.com>", "<4@example.com>"]
+
+
+def test_direction_from_own_address(delivered):
+    assert [m["direction"] for m in delivered.messages("Engine notes")] == ["received", "sent", "received"]
+
+
+def test_dot_stuffing_undone(delivered):
+    assert delivered.messages("Engine notes")[0]["content"].endswith("\n.leading dot")
+
+
+def test_maildir_reply_by_subject(delivered):
+    assert [m["message_id"] for m in delivered.messages("Travel plans")] == ["<5@example.com>", "<6@example.com>"]
+
+
+def test_unknown_sender_skipped(delivered):
+    assert delivered.ingestor.stats["unmatched"] == 1
+
+
+def test_duplicate_skipped(delivered):
+    assert delivered.ingestor.stats["duplicate"] == 1
+
+
+def test_maildir_moved_to_cur(delivered):
+    assert os.listdir(delivered.new_dir) == []
+    assert sorted(os.listdir(os.path.join(delivered.maildir.path, "cur"))) == ["a:2,S", "b:2,S"]
+
+
+# ----------------------------
+# Failed commits are retried, never acknowledged or skipped over
+# ----------------------------
+def test_failed_smtp_delivery_answered_451_then_stored(delivered):
+    retry = mail("ada@example.com", "Engine notes", "Retry over SMTP.", "<7@example.com>")
+    real_writer, delivered.ingestor.writer = delivered.ingestor.writer, FailingWriter()
+    with pytest.raises(smtplib.SMTPDataError) as failure:
+        delivered.send(retry)
+    assert failure.value.smtp_code == 451
+
+    delivered.ingestor.writer = real_writer
+    delivered.send(retry)
+    assert delivered.messages("Engine notes")[-1]["message_id"] == "<7@example.com>"
+
+
+def test_mbox_offset_held_at_failed_message(delivered):
+    position = delivered.ingestor.get_position(delivered.mbox.key)
+    real_writer, delivered.ingestor.writer = delivered.ingestor.writer, FailingWriter()
+    append_mbox(delivered.mbox_path, mail("ada@example.com", "Engine notes", "Retry from mbox.", "<8@example.com>"))
+    delivered.mbox.poll(delivered.ingestor)
+    assert delivered.ingestor.get_position(delivered.mbox.key) == position
+
+    delivered.ingestor.writer = real_writer
+    delivered.mbox.poll(delivered.ingestor)
+    assert delivered.messages("Engine notes")[-1]["message_id"] == "<8@example.com>"
+    assert delivered.ingestor.get_position(delivered.mbox.key) == os.path.getsize(delivered.mbox_path)
+
+
+def test_failed_maildir_file_kept_in_new(delivered):
+    real_writer, delivered.ingestor.writer = delivered.ingestor.writer, FailingWriter()
+    drop_maildir(delivered.maildir, "c", mail("ada@example.com", "Engine notes", "Retry from maildir.",
+                                              "<9@example.com>"))
+    delivered.maildir.poll(delivered.ingestor)
+    assert os.listdir(delivered.new_dir) == ["c"]
+
+    delivered.ingestor.writer = real_writer
+    delivered.maildir.poll(delivered.ingestor)
+    assert os.listdir(delivered.new_dir) == []
+    assert delivered.messages("Engine notes")[-1]["message_id"] == "<9@example.com>"
+
+
+def test_mail_without_message_id_stored_once(delivered):
+    # Re-read on every poll while the failing message ahead of it holds the mbox offset
+    delivered.ingestor.writer = PoisonWriter(delivered.ingestor.writer, "Poison")
+    append_mbox(
+        delivered.mbox_path,
+        mail("ada@example.com", "Engine notes", "Poison pill.", "<11@example.com>"),
+        mail("ada@example.com", "Engine notes", "No Message-ID here.", ""),
+    )
+    for _ in range(3):
+        delivered.mbox.poll(delivered.ingestor)
+    assert [m["content"] for m in delivered.messages("Engine notes")].count("No Message-ID here.") == 1
+
+
+def test_repeatedly_failing_mail_dead_lettered(delivered):
+    ingestor = delivered.ingestor
+    ingestor.writer = PoisonWriter(ingestor.writer, "Poison")
+    append_mbox(delivered.mbox_path, mail("ada@example.com", "Engine notes", "Poison pill.", "<11@example.com>"))
+    for _ in range(ingestor.max_attempts):
+        delivered.mbox.poll(ingestor)
+
+    assert ingestor.stats["dead_lettered"] == 1
+    assert len(os.listdir(ingestor.dead_letter_dir)) == 1
+    assert "<11@example.com>" not in {m["message_id"] for m in delivered.messages("Engine notes")}
+    assert ingestor.get_position(delivered.mbox.key) == os.path.getsize(delivered.mbox_path)
+
+
+# ----------------------------
+# Archived threads
+# ----------------------------
+# Their messages only live in the archive blob. A fresh ingestor, as after a
+# restart, so nothing is answered from the queued-id cache.
+@pytest.fixture
+def restarted(delivered):
+    delivered.repo.archive_conversation(delivered.conversations()["Travel plans"])
+    return MailIngestor(delivered.db_path, own_addresses=[OWN_ADDRESS])
+
+
+def test_archived_duplicate_skipped(delivered, restarted):
+    drop_maildir(delivered.maildir, "d", mail("ada@example.com", "Re: Travel plans", "Maildir reply.",
+                                              "<6@example.com>"))
+    delivered.maildir.poll(restarted)
+    assert restarted.stats["duplicate"] == 1
+    assert delivered.repo.is_archived(delivered.conversations()["Travel plans"])
+
+
+def test_reply_to_archived_thread_restores_it(delivered, restarted):
+    drop_maildir(delivered.maildir, "e", mail("ada@example.com", "Changed subject", "Reply to archived.",
+                                              "<10@example.com>", "<5@example.com>"))
+    delivered.maildir.poll(restarted)
+    assert not delivered.repo.is_archived(delivered.conversations()["Travel plans"])
+    assert [m["message_id"] for m in delivered.messages("Travel plans")] == [
+        "<5@example.com>", "<6@example.com>", "<10@example.com>"
+    ]
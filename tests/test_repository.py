@@ -0,0 +1,153 @@
+import sqlite3
+
+import pytest
+
+from repository import QUERY_BUDGETS, Repository, assert_query_budget, migrate
+
+SCALE = 25  # contacts, conversations per contact and messages per conversation are all this size
+
+
+def memory_repository() -> Repository:
+    conn = sqlite3.connect(":memory:")
+    migrate(conn)
+    return Repository(conn)
+
+
+# ----------------------------
+# Statement budgets
+# ----------------------------
+@pytest.fixture
+def seeded():
+    repo = memory_repository()
+    contact_ids = [repo.add_contact(f"Contact {i}", f"c{i}@example.com") for i in range(SCALE)]
+    conversation_ids = [repo.add_conversation(cid, f"Thread {cid}") for cid in contact_ids]
+    repo.add_messages([
+        {"conversation_id": cid, "content": f"Message {n} " * 40, "direction": "received" if n % 2 else "sent"}
+        for cid in conversation_ids for n in range(SCALE)
+    ])
+    return repo, contact_ids, conversation_ids
+
+
+# operation -> call(repo, contact_ids, conversation_ids), one per QUERY_BUDGETS entry
+OPERATIONS = {
+    "list_contacts": lambda repo, contacts, conversations: repo.list_contacts(),
+    "get_contact": lambda repo, contacts, conversations: repo.get_contact(contacts[0]),
+    "contact_profile_sources": lambda repo, contacts, conversations: repo.contact_profile_sources(contacts[0], 20),
+    "save_contact_profile": lambda repo, contacts, conversations: repo.save_contact_profile(
+        contacts[0], "Budget check", {"notes": "0" * 64}
+    ),
+    "list_conversations": lambda repo, contacts, conversations: repo.list_conversations(),
+    "get_conversation": lambda repo, contacts, conversations: repo.get_conversation(conversations[0]),
+    "get_messages": lambda repo, contacts, conversations: repo.get_messages(conversations[0]),
+    "get_messages_page": lambda repo, contacts, conversations: repo.get_messages(
+        conversations[0], before_sequence=SCALE, limit=10
+    ),
+    "get_messages_empty_delta": lambda repo, contacts, conversations: repo.get_messages(
+        conversations[0], since_sequence=SCALE, archived=False
+    ),
+    "recent_prompt_messages": lambda repo, contacts, conversations: repo.recent_prompt_messages(conversations[0], 5),
+    "find_contacts_by_email": lambda repo, contacts, conversations: repo.find_contacts_by_email(
+        [f"C{i}@example.com" for i in range(SCALE)]
+    ),
+    "find_conversation_by_message_ids": lambda repo, contacts, conversations: repo.find_conversation_by_message_ids(
+        ["<a@x>", "<b@x>"]
+    ),
+    "find_conversation_by_title": lambda repo, contacts, conversations: repo.find_conversation_by_title(
+        contacts[0], "thread 1"
+    ),
+    "add_contact": lambda repo, contacts, conversations: repo.add_contact("Budget Check"),
+    "add_conversation": lambda repo, contacts, conversations: repo.add_conversation(contacts[0], "Budget Check"),
+    "add_message": lambda repo, contacts, conversations: repo.add_message(
+        conversations[0], "Thanks, see you Thursday.", "received"
+    ),
+    "add_messages_bulk": lambda repo, contacts, conversations: repo.add_messages([
+        {"conversation_id": cid, "content": "Bulk import", "direction": "received"}
+        for cid in conversations for _ in range(3)
+    ]),
+}
+
+
+def test_every_budget_is_exercised():
+    assert set(OPERATIONS) == set(QUERY_BUDGETS)
+
+
+@pytest.mark.parametrize("operation", list(QUERY_BUDGETS))
+def test_query_budget(seeded, operation):
+    repo, contact_ids, conversation_ids = seeded
+    assert_query_budget(repo, operation, lambda: OPERATIONS[operation](repo, contact_ids, conversation_ids))
+
+
+def test_empty_delta_is_empty(seeded):
+    repo, _, conversation_ids = seeded
+    assert repo.get_messages(conversation_ids[0], since_sequence=SCALE, archived=False) == ([], False)
+
+
+# ----------------------------
+# Archive round trip
+# ----------------------------
+@pytest.fixture
+def archived():
+    """A two-message thread (the second quoting the first), archived, plus a live thread of the same contact"""
+    repo = memory_repository()
+    contact_id = repo.add_contact("Archive Check")
+    archived_id = repo.add_conversation(contact_id, "Archived")
+    other_id = repo.add_conversation(contact_id, "Other")
+    repo.add_messages([{"conversation_id": archived_id, "content": "Could you send the signed contract by Friday?",
+                        "direction": "received", "message_id": "<contract@example.com>"}])
+    repo.add_message(
+        archived_id,
+        "Sent, see attached.\n\nOn Monday, Archive Check wrote:\n> Could you send the signed contract by Friday?",
+        "sent"
+    )
+    before, _ = repo.get_messages(archived_id)
+    repo.archive_conversation(archived_id)
+    return repo, archived_id, other_id, before
+
+
+def test_archived_thread_reads_from_archive(archived):
+    repo, archived_id, _, before = archived
+    expected = [(m["sequence"], m["content"]) for m in before]
+    assert repo.is_archived(archived_id)
+    assert [(m["sequence"], m["content"]) for m in repo.get_messages(archived_id, archived=True)[0]] == expected
+    assert [(m["sequence"], m["content"]) for m in repo.get_messages(archived_id)[0]] == expected
+
+
+def test_archived_message_ids_stay_findable(archived):
+    repo, archived_id, _, _ = archived
+    assert repo.find_conversation_by_message_ids(["<contract@example.com>"]) == archived_id
+
+
+def test_unarchive_restores_messages(archived):
+    repo, archived_id, _, before = archived
+    repo.unarchive_conversation(archived_id)
+    after, _ = repo.get_messages(archived_id)
+    assert not repo.is_archived(archived_id)
+    assert [(m["sequence"], m["content"]) for m in after] == [(m["sequence"], m["content"]) for m in before]
+    assert repo.conn.execute("SELECT COUNT(*) FROM archived_message_ids").fetchone()[0] == 0
+
+
+def test_restored_messages_get_fresh_ids(archived):
+    # Inserts while archived reuse the freed ids; the restored messages must not collide with them
+    repo, archived_id, other_id, _ = archived
+    repo.add_messages([{"conversation_id": other_id, "content": f"Other {n}", "direction": "sent"} for n in range(3)])
+    repo.unarchive_conversation(archived_id)
+    restored_ids = {m["id"] for m in repo.get_messages(archived_id)[0]}
+    other_ids = {m["id"] for m in repo.get_messages(other_id)[0]}
+    assert not restored_ids & other_ids
+
+
+def test_quoted_message_id_remapped(archived):
+    repo, archived_id, other_id, before = archived
+    repo.add_messages([{"conversation_id": other_id, "content": f"Other {n}", "direction": "sent"} for n in range(3)])
+    repo.unarchive_conversation(archived_id)
+    after, _ = repo.get_messages(archived_id)
+    quoted = [m["quoted_message_id"] for m in after if m["quoted_message_id"] is not None]
+    assert len(quoted) == len([m for m in before if m["quoted_message_id"]]) == 1
+    assert set(quoted) <= {m["id"] for m in after}
+
+
+def test_add_message_into_archived_thread_continues_history(archived):
+    repo, archived_id, _, before = archived
+    message = repo.add_message(archived_id, "One more thing.", "received")
+    assert not repo.is_archived(archived_id)
+    assert message["sequence"] == len(before) + 1
@@ -0,0 +1,221 @@
+import os
+import time
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sharding import DEFAULT_TENANT
+
+logger = logging.getLogger(__name__)
+
+# ----------------------------
+# Per-call LLM usage ledger
+# ----------------------------
+# Calls are recorded into an in-memory queue and written in batches by a
+# background thread, so recording never adds a DB round trip to a request.
+
+LEDGER_TABLE = "llm_usage"
+
+# Same columns as app.py's LlmUsage model, for the raw sqlite3 app (tenant_id is
+# added by a later repository.py migration)
+LEDGER_DDL = f"""
+    CREATE TABLE IF NOT EXISTS {LEDGER_TABLE} (
+        id INTEGER PRIMARY KEY,
+        created_at TIMESTAMP NOT NULL,
+        source TEXT,
+        call_type TEXT NOT NULL,
+        model TEXT,
+        conversation_id INTEGER,
+        contact_id INTEGER,
+        prompt_tokens INTEGER,
+        response_tokens INTEGER,
+        latency_ms REAL,
+        cache_hit INTEGER DEFAULT 0,
+        error TEXT
+    )
+"""
+LEDGER_INDEX_DDL = f"CREATE INDEX IF NOT EXISTS ix_{LEDGER_TABLE}_created_at ON {LEDGER_TABLE} (created_at)"
+
+# USD per 1K tokens; defaults match gemini-2.0-flash list pricing
+PROMPT_COST_PER_1K = float(os.getenv("LLM_PROMPT_COST_PER_1K", 0.0001))
+RESPONSE_COST_PER_1K = float(os.getenv("LLM_RESPONSE_COST_PER_1K", 0.0004))
+
+
+def usage_from_response(response) -> Tuple[Optional[int], Optional[int]]:
+    """Prompt/response token counts from a Gemini response, if the SDK reports them"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return None, None
+    return getattr(usage, "prompt_token_count", None), getattr(usage, "candidates_token_count", None)
+
+
+class UsageLedger:
+    """Buffers usage entries and hands them to ``sink`` in batches.
+
+    ``sink`` receives a list of row dicts and must write them in one transaction.
+    Entries are dropped (and counted) rather than blocking callers if the
+    buffer is full.
+    """
+
+    def __init__(
+        self,
+        sink: Callable[[List[Dict[str, Any]]], None],
+        source: str,
+        flush_interval: float = 2.0,
+        max_batch: int = 200,
+        max_pending: int = 10000,
+    ):
+        self.sink = sink
+        self.source = source
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.dropped = 0
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=max_pending)
+        self._flush_lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def record(self, call_type: str, model: Optional[str] = None, conversation_id: Optional[int] = None,
+               contact_id: Optional[int] = None, prompt_tokens: Optional[int] = None,
+               response_tokens: Optional[int] = None, latency_ms: Optional[float] = None,
+               cache_hit: bool = False, error: Optional[str] = None, tenant_id: Optional[str] = None) -> None:
+        self._ensure_worker()
+        entry = {
+            "created_at": datetime.utcnow(),
+            "source": self.source,
+            "tenant_id": tenant_id or DEFAULT_TENANT,
+            "call_type": call_type,
+            "model": model,
+            "conversation_id": conversation_id,
+            "contact_id": contact_id,
+            "prompt_tokens": prompt_tokens,
+            "response_tokens": response_tokens,
+            "latency_ms": latency_ms,
+            "cache_hit": bool(cache_hit),
+            "error": error[:500] if error else None,
+        }
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def track(self, call: Callable[[], Any], call_type: str, model: Optional[str] = None,
+              conversation_id: Optional[int] = None, contact_id: Optional[int] = None,
+              tenant_id: Optional[str] = None) -> Any:
+        """Run one model call, recording latency, token usage and any error"""
+        started = time.perf_counter()
+        try:
+            response = call()
+        except Exception as e:
+            self.record(call_type, model, conversation_id, contact_id,
+                        latency_ms=(time.perf_counter() - started) * 1000, error=str(e), tenant_id=tenant_id)
+            raise
+
+        prompt_tokens, response_tokens = usage_from_response(response)
+        self.record(call_type, model, conversation_id, contact_id, prompt_tokens, response_tokens,
+                    latency_ms=(time.perf_counter() - started) * 1000, tenant_id=tenant_id)
+        return response
+
+    def flush(self) -> None:
+        """Write everything buffered so far (called by the worker and at exit)"""
+        with self._flush_lock:
+            while True:
+                batch = []
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not batch:
+                    return
+                try:
+                    self.sink(batch)
+                except Exception as e:
+                    logger.error(f"Failed to write {len(batch)} usage ledger entries: {str(e)}")
+                    return
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None:
+            return
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="usage-ledger", daemon=True)
+                self._worker.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+def usage_report(conn, days: int = 30, tenant_id: Optional[str] = None) -> Dict[str, Any]:
+    """Aggregate the ledger per tenant, day, conversation and contact over the last ``days`` days.
+
+    Conversation and contact ids are only unique within a tenant's shard, so
+    those groups are keyed by (tenant_id, id). ``tenant_id`` limits the report
+    to one tenant. Rows written before tenants were recorded count as the
+    default tenant.
+    """
+    since = (datetime.utcnow() - timedelta(days=days)).isoformat(sep=" ")
+    tenant_sql = f"COALESCE(tenant_id, '{DEFAULT_TENANT}')"
+    where, params = "created_at >= ?", [since]
+    if tenant_id is not None:
+        where += f" AND {tenant_sql} = ?"
+        params.append(tenant_id)
+    aggregates = f"""
+        COUNT(*) AS calls,
+        COALESCE(SUM(error IS NOT NULL), 0) AS errors,
+        COALESCE(SUM(cache_hit), 0) AS cache_hits,
+        COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+        COALESCE(SUM(response_tokens), 0) AS response_tokens,
+        AVG(latency_ms) AS avg_latency_ms,
+        MAX(latency_ms) AS max_latency_ms
+    """
+
+    def grouped(*keys: Tuple[str, str]) -> List[Dict[str, Any]]:
+        key_sql = ", ".join(sql for sql, _ in keys)
+        rows = conn.execute(
+            f"SELECT {key_sql}, {aggregates} FROM {LEDGER_TABLE} "
+            f"WHERE {where} GROUP BY {key_sql} ORDER BY {key_sql}",
+            params,
+        ).fetchall()
+        return [
+            _report_row({name: value for (_, name), value in zip(keys, row)}, row[len(keys):])
+            for row in rows
+        ]
+
+    totals = conn.execute(
+        f"SELECT {aggregates} FROM {LEDGER_TABLE} WHERE {where}", params
+    ).fetchone()
+
+    tenant = (tenant_sql, "tenant_id")
+    return {
+        "days": days,
+        "tenant_id": tenant_id,
+        "totals": _report_row({}, totals),
+        "by_tenant": grouped(tenant),
+        "by_day": grouped(("date(created_at)", "day")),
+        "by_conversation": grouped(tenant, ("conversation_id", "conversation_id")),
+        "by_contact": grouped(tenant, ("contact_id", "contact_id")),
+        "by_call_type": grouped(("call_type", "call_type")),
+    }
+
+
+def _report_row(key: Dict[str, Any], values) -> Dict[str, Any]:
+    calls, errors, cache_hits, prompt_tokens, response_tokens, avg_latency, max_latency = values
+    cost = prompt_tokens / 1000 * PROMPT_COST_PER_1K + response_tokens / 1000 * RESPONSE_COST_PER_1K
+    return {
+        **key,
+        "calls": calls,
+        "errors": errors,
+        "cache_hits": cache_hits,
+        "prompt_tokens": prompt_tokens,
+        "response_tokens": response_tokens,
+        "estimated_cost_usd": round(cost, 6),
+        "avg_latency_ms": round(avg_latency, 1) if avg_latency is not None else None,
+        "max_latency_ms": round(max_latency, 1) if max_latency is not None else None,
+    }